@@ -75,7 +75,13 @@ enum
     NUM_LEDS,
     DATA_LEDS,
     PRESCALER,
-    CRC
+    CRC,
+    NUM_SEGMENTS,
+    TABLE_UID,
+    TABLE_NUM_LEDS,
+    TABLE_CRC,
+    MULTI_DATA_LEDS,
+    NUM_ITEMS
 } state = IDLE;
 
 //
@@ -86,8 +92,14 @@ typedef enum
     CMD_LEDS = 1,
     CMD_SERIAL_BAUDRATE = 2,
     CMD_BOOTLOADER = 3,
+    CMD_LEDS_MULTI = 4,
+    CMD_LEDS_RLE = 5,
+    CMD_LEDS_PALETTE = 6,
+    CMD_LATCH = 7,
 } Cmd;
 Cmd cmd;
+// UID the current message was sent to, this board's or BROADCAST_UID
+uint8_t msg_uid;
 
 // Message: Set serial baudrate
 // The baudrate is given as a clock prescaler value. See definition of InitSerial() for details.
@@ -114,22 +126,145 @@ struct __attribute__((packed)) LedMsg
 };
 LedColor led_colors[MAX_NUM_LEDS];
 uint8_t *led_colors_bytes = reinterpret_cast<uint8_t *>(led_colors);
+// Number of payload bytes of the LED message being received
+uint16_t payload_size;
+
+// Message: Set Leds, run-length encoded
+// The payload is a list of runs of num_leds LEDs in total. The payload is stored in
+// led_colors as is and decoded while sending the pixels, so it has to fit into led_colors.
+struct __attribute__((packed)) LedRun
+{
+    uint8_t count;
+    LedColor color;
+};
+struct __attribute__((packed)) LedRleMsg
+{
+    uint8_t magic;
+    uint8_t uid;
+    Cmd cmd = CMD_LEDS_RLE;
+    uint8_t num_leds;
+    uint8_t num_runs;
+    LedRun runs[MAX_NUM_LEDS * sizeof(LedColor) / sizeof(LedRun)];
+    uint8_t crc;
+};
+
+// Message: Set Leds, palette indexed
+// The payload is the palette followed by one palette index per LED. Like the run-length
+// encoded payload, it is stored in led_colors and decoded while sending the pixels.
+struct __attribute__((packed)) LedPaletteMsg
+{
+    uint8_t magic;
+    uint8_t uid;
+    Cmd cmd = CMD_LEDS_PALETTE;
+    uint8_t num_leds;
+    uint8_t num_colors;
+    // LedColor palette[num_colors];
+    // uint8_t indices[num_leds];
+    uint8_t crc;
+};
+uint8_t num_items;
+
+// Message: Set Leds of several boards (always sent to BROADCAST_UID)
+// The header is followed by a table with the UID and number of LEDs of every segment in the
+// message and the CRC of the table (including num_segments). After that come the LED data
+// and CRC of each segment, in the order of the table, exactly as in LedMsg. Every board
+// computes where its own slice starts from the table and only reads and checks that slice.
+struct __attribute__((packed)) LedMultiMsgHeader
+{
+    uint8_t magic;
+    uint8_t uid = BROADCAST_UID;
+    Cmd cmd = CMD_LEDS_MULTI;
+    uint8_t num_segments;
+};
+struct __attribute__((packed)) LedMultiMsgTableEntry
+{
+    uint8_t uid;
+    uint8_t num_leds;
+};
+uint8_t num_segments;
+uint8_t table_crc;
+// Set once this board's UID was found in the table
+bool multi_found;
+// Start and end of the slice of this board in the data of the message
+uint16_t multi_start;
+uint16_t multi_end;
+
+// Message: Latch (always sent to BROADCAST_UID)
+// Shows the LED data received since the previous latch on all boards of the bus at the same
+// time. Boards show LED data as soon as it arrives until they receive the first latch. If
+// LED data arrives while earlier data is still waiting for a latch, the host stopped
+// sending latches and the board goes back to showing LED data right away.
+struct __attribute__((packed)) LatchMsg
+{
+    uint8_t magic;
+    uint8_t uid = BROADCAST_UID;
+    Cmd cmd = CMD_LATCH;
+    // CRC of magic, uid and cmd
+    uint8_t crc;
+};
+bool latch_enabled = false;
+// Set while LED data in led_colors waits for a latch
+bool latch_pending = false;
+Cmd latch_cmd;
+
+// Send a single R5G6B5 pixel
+inline void sendPixelR5G6B5(const uint16_t elem)
+{
+  uint8_t bytes[3];
+  bytes[0] = (elem >> 3) & 0xFC;
+  bytes[1] = (elem >> 8) & 0xF8;
+  bytes[2] = (elem << 3) & 0xF8;
+  fab_led.sendBytes(3, bytes);
+}
 
 // R5G6B5 version of sendPixels
 void sendPixelsR5G6B5(
     const uint16_t count,
     uint16_t * pixelArray)
 {
-  uint8_t bytes[3];
+  for (uint16_t i = 0; i < count; i++) 
+  {
+    sendPixelR5G6B5(pixelArray[i]);
+  }
+}
+
+// Run-length encoded version of sendPixels
+void sendPixelsRle(
+    const uint8_t numRuns,
+    const LedRun * runs)
+{
+  for (uint8_t i = 0; i < numRuns; i++) 
+  {
+    for (uint8_t j = 0; j < runs[i].count; j++) 
+    {
+      sendPixelR5G6B5(runs[i].color);
+    }
+  }
+}
 
+// Palette indexed version of sendPixels
+void sendPixelsPalette(
+    const uint16_t count,
+    const uint16_t * palette,
+    const uint8_t * indices)
+{
   for (uint16_t i = 0; i < count; i++) 
   {
-    const uint16_t elem = pixelArray[i];
-    bytes[0] = (elem >> 3) & 0xFC;
-    bytes[1] = (elem >> 8) & 0xF8;
-    bytes[2] = (elem << 3) & 0xF8;
-    fab_led.sendBytes(3, bytes);
+    sendPixelR5G6B5(palette[indices[i]]);
+  }
+}
+
+// Number of LEDs in a run-length encoded payload
+uint16_t countRleLeds(
+    const uint8_t numRuns,
+    const LedRun * runs)
+{
+  uint16_t count = 0;
+  for (uint8_t i = 0; i < numRuns; i++) 
+  {
+    count += runs[i].count;
   }
+  return count;
 }
 
 void sendPixelsSolidColor(const uint16_t numPixels, const grb * color)
@@ -140,6 +275,60 @@ void sendPixelsSolidColor(const uint16_t numPixels, const grb * color)
   }
 }
 
+// Push the LED data in led_colors to the LEDs. ledCmd is the command it was received with.
+void showLeds(const Cmd ledCmd)
+{
+  num_leds = new_num_leds;
+  switch (ledCmd)
+  {
+  case CMD_LEDS_RLE:
+    sendPixelsRle(num_items, reinterpret_cast<LedRun *>(led_colors_bytes));
+    break;
+  case CMD_LEDS_PALETTE:
+    sendPixelsPalette(num_leds, led_colors, led_colors_bytes + num_items * sizeof(LedColor));
+    break;
+  default:
+    sendPixelsR5G6B5(num_leds, led_colors);
+    break;
+  }
+}
+
+// Show new LED data right away, or on the next latch once the host sends latches
+void updateLeds(const Cmd ledCmd)
+{
+  if (latch_enabled)
+  {
+    latch_cmd = ledCmd;
+    latch_pending = true;
+  }
+  else
+  {
+    showLeds(ledCmd);
+  }
+}
+
+// Called before new LED data overwrites led_colors
+void discardPendingLeds()
+{
+  if (latch_pending)
+  {
+    // The previous data was never latched
+    latch_enabled = false;
+    latch_pending = false;
+  }
+}
+
+// Add a byte to a CRC8. Fast enough to run between two bytes on the serial port.
+inline uint8_t Crc8Update(uint8_t crc, uint8_t data)
+{
+    crc ^= data;
+    for (uint8_t i = 0; i < 8; i++)
+    {
+        crc = (crc & 0x80) ? (crc << 1) ^ CRC_POLYNOMIAL : crc << 1;
+    }
+    return crc;
+}
+
 // Helper function to print a value in binary WITH leading zeros.
 void PrintBinary(uint8_t data, bool line_feed)
 {
@@ -220,8 +409,10 @@ void setup()
 void loop()
 {
 
-    // Wait for messages
-    uint8_t c = GetSerialByte(state == CRC);
+    // Wait for messages. The CRC of this board's slice in a multi-segment message is the last
+    // byte it reads from that message.
+    uint8_t c = GetSerialByte(
+        state == CRC || (state == MULTI_DATA_LEDS && byte_index == multi_end));
     switch (state)
     {
     case IDLE:
@@ -243,6 +434,7 @@ void loop()
     case UID:
         if (c == uid || c == BROADCAST_UID)
         {
+            msg_uid = c;
             state = CMD;
             byte_index = 0;
         }
@@ -264,6 +456,8 @@ void loop()
         switch (c)
         {
         case CMD_LEDS:
+        case CMD_LEDS_RLE:
+        case CMD_LEDS_PALETTE:
             state = NUM_LEDS;
             break;
         case CMD_SERIAL_BAUDRATE:
@@ -272,6 +466,12 @@ void loop()
         case CMD_BOOTLOADER:
             startBootloader();
             break;
+        case CMD_LEDS_MULTI:
+            state = NUM_SEGMENTS;
+            break;
+        case CMD_LATCH:
+            state = CRC;
+            break;
         default:
             if (VERBOSE)
             {
@@ -286,6 +486,7 @@ void loop()
         }
         break;
     case NUM_LEDS:
+        discardPendingLeds();
         new_num_leds = c;
         if (new_num_leds > MAX_NUM_LEDS)
         {
@@ -293,15 +494,43 @@ void loop()
           state = IDLE;
           FlushSerial();
         }
+        else if (cmd == CMD_LEDS)
+        {
+          payload_size = new_num_leds * 2;
+          state = payload_size ? DATA_LEDS : CRC;
+          byte_index = 0;
+        }
+        else
+        {
+          state = NUM_ITEMS;
+        }
+        break;
+    case NUM_ITEMS:
+        // Number of runs or palette colors
+        num_items = c;
+        if (cmd == CMD_LEDS_RLE)
+        {
+          payload_size = num_items * sizeof(LedRun);
+        }
         else
         {
-          state = DATA_LEDS;
+          payload_size = num_items * sizeof(LedColor) + new_num_leds;
+        }
+        if (payload_size > sizeof(led_colors))
+        {
+          // Ignore payloads that don't fit
+          state = IDLE;
+          FlushSerial();
+        }
+        else
+        {
+          state = payload_size ? DATA_LEDS : CRC;
           byte_index = 0;
         }
         break;
     case DATA_LEDS:
         led_colors_bytes[byte_index++] = c;
-        if (byte_index == new_num_leds * 2)
+        if (byte_index == payload_size)
         {
             state = CRC;
         }
@@ -310,6 +539,72 @@ void loop()
         prescaler = c;
         state = CRC;
         break;
+    case NUM_SEGMENTS:
+        num_segments = c;
+        table_crc = Crc8Update(0, c);
+        multi_found = false;
+        multi_start = 0;
+        byte_index = 0;
+        state = num_segments ? TABLE_UID : IDLE;
+        break;
+    case TABLE_UID:
+        table_crc = Crc8Update(table_crc, c);
+        if (c == uid && !multi_found)
+        {
+            multi_found = true;
+            // The data of all segments before this one, 2 bytes per LED plus a CRC
+            multi_start = byte_index;
+        }
+        state = TABLE_NUM_LEDS;
+        break;
+    case TABLE_NUM_LEDS:
+        table_crc = Crc8Update(table_crc, c);
+        if (multi_found && multi_start == byte_index)
+        {
+            discardPendingLeds();
+            new_num_leds = c;
+        }
+        byte_index += c * 2 + 1;
+        state = --num_segments ? TABLE_UID : TABLE_CRC;
+        break;
+    case TABLE_CRC:
+        if (c != table_crc || !multi_found || new_num_leds > MAX_NUM_LEDS)
+        {
+            // Bad table or no LEDs for this board. Wait for the next message.
+            state = IDLE;
+            FlushSerial();
+        }
+        else
+        {
+            multi_end = multi_start + new_num_leds * 2;
+            byte_index = 0;
+            state = MULTI_DATA_LEDS;
+        }
+        break;
+    case MULTI_DATA_LEDS:
+        if (byte_index == multi_end)
+        {
+            // This board's CRC. The rest of the message is for other boards.
+            state = IDLE;
+            if (c == crc8(led_colors_bytes, new_num_leds * 2, CRC_POLYNOMIAL))
+            {
+                updateLeds(CMD_LEDS);
+            }
+            else if (VERBOSE)
+            {
+                interrupts();
+                debug_serial.print("Bad CRC: 0x");
+                debug_serial.println(c, HEX);
+                noInterrupts();
+            }
+            break;
+        }
+        if (byte_index >= multi_start)
+        {
+            led_colors_bytes[byte_index - multi_start] = c;
+        }
+        byte_index++;
+        break;
     case CRC:
         state = IDLE;
         // compute what the CRC should be
@@ -317,11 +612,19 @@ void loop()
         switch (cmd)
         {
         case CMD_LEDS:
-            crc = crc8(led_colors_bytes, new_num_leds * 2, CRC_POLYNOMIAL);
+        case CMD_LEDS_RLE:
+        case CMD_LEDS_PALETTE:
+            crc = crc8(led_colors_bytes, payload_size, CRC_POLYNOMIAL);
             break;
         case CMD_SERIAL_BAUDRATE:
             crc = crc8(&prescaler, 1, CRC_POLYNOMIAL);
             break;
+        case CMD_LATCH:
+        {
+            const uint8_t header[] = {MAGIC_BYTE, msg_uid, CMD_LATCH};
+            crc = crc8(header, sizeof(header), CRC_POLYNOMIAL);
+            break;
+        }
         default:
             break;
         }
@@ -339,9 +642,26 @@ void loop()
                     debug_serial.print(" -> ");
                     debug_serial.println(new_num_leds);
                     noInterrupts();
-                    num_leds = new_num_leds;
                 }
-                sendPixelsR5G6B5(num_leds, led_colors);
+                updateLeds(CMD_LEDS);
+                break;
+            case CMD_LEDS_RLE:
+                // Ignore messages whose runs don't add up to the number of LEDs
+                if (countRleLeds(num_items, reinterpret_cast<LedRun *>(led_colors_bytes)) == new_num_leds)
+                {
+                    updateLeds(CMD_LEDS_RLE);
+                }
+                break;
+            case CMD_LEDS_PALETTE:
+                updateLeds(CMD_LEDS_PALETTE);
+                break;
+            case CMD_LATCH:
+                latch_enabled = true;
+                if (latch_pending)
+                {
+                    latch_pending = false;
+                    showLeds(latch_cmd);
+                }
                 break;
             case CMD_SERIAL_BAUDRATE:
                 InitSerial(prescaler);
@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import json
+import numpy as np
+import platform
+import sys
+import time
+import tracemalloc
+import types
+
+from funky_lights import messages
+from core.bus_routing import BusLayout
+from core.dmx_udp import DmxUdpEncoder, compile_universe_layout
+from core.frame_ring import FrameRing
+from core.frame_stats import FrameStats, Histogram
+from core.opc import OpcBusEncoder, OpenPixelControlProtocol
+from core.output_levels import output_levels, rgb_lut
+from core.pattern_mixer import PatternMix
+from core.websockets import TEXTURE_FORMATS, TextureWebSocketsServer
+from patterns import pattern_config
+
+
+class NullTransport(asyncio.Transport):
+    """ Transport that discards everything written to it. """
+
+    def __init__(self):
+        super().__init__()
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+    def is_closing(self):
+        return False
+
+
+async def measure(step, num_frames, num_memory_frames):
+    """ Measure a step function that renders or encodes a single frame.
+    Returns:
+     a dict with timings in ms/frame, transient allocations per frame and peak memory
+    """
+    # Timing pass
+    histogram = Histogram(num_frames)
+    for _ in range(num_frames):
+        start = time.perf_counter()
+        await step()
+        histogram.add((time.perf_counter() - start) * 1000)
+    timings = histogram.to_dict()
+
+    # Memory pass. Separate, because tracing slows down execution considerably.
+    tracemalloc.start()
+    start_size, _ = tracemalloc.get_traced_memory()
+    allocated = []
+    for _ in range(num_memory_frames):
+        tracemalloc.reset_peak()
+        frame_start_size, _ = tracemalloc.get_traced_memory()
+        await step()
+        _, frame_peak_size = tracemalloc.get_traced_memory()
+        allocated.append(frame_peak_size - frame_start_size)
+    _, peak_size = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'ms_per_frame': timings['mean'],
+        'p95_ms': timings['p95'],
+        'max_ms': timings['max'],
+        'alloc_kib_per_frame': float(np.mean(allocated)) / 1024 if allocated else 0.0,
+        'peak_kib': (peak_size - start_size) / 1024,
+    }
+
+
+def create_pattern(cls, params, led_config):
+    pattern = cls()
+    for key in params:
+        setattr(pattern.params, key, params[key])
+    pattern.prepareSegments(led_config)
+    pattern.initialize()
+    return pattern
+
+
+async def benchmark_patterns(args, led_config):
+    results = {}
+    patterns = {}
+    delta = 1.0 / args.animation_rate
+    for d in pattern_config.DEFAULT_CONFIG:
+        for pattern_id, (cls, params) in d.items():
+            name = '%s %s' % (pattern_id, cls.__name__)
+            try:
+                pattern = create_pattern(cls, params, led_config)
+                results[name] = await measure(
+                    lambda: pattern.animate(delta), args.num_frames, args.num_memory_frames)
+                patterns[pattern_id] = pattern
+            except Exception as exc:
+                results[name] = {'error': repr(exc)}
+            print('%-32s %s' % (name, format_result(results[name])))
+
+    # Full mix: first rotation pattern, eye patterns and all effects on top
+    pattern_mix = PatternMix(patterns, None)
+    pattern_mix.prepareSegments(led_config)
+    pattern_mix.initialize()
+    pattern_mix.update_mix(
+        base_pattern_ids=[pid for pid in pattern_config.DEFAULT_CONFIG.rotation if pid in patterns][:1],
+        replace_pattern_ids=[pid for pid in pattern_config.DEFAULT_CONFIG.eyes if pid in patterns],
+        mix_pattern_ids=[pid for pid in pattern_config.DEFAULT_CONFIG.special_effects if pid in patterns])
+    results['PatternMix'] = await measure(
+        lambda: pattern_mix.animate(delta), args.num_frames, args.num_memory_frames)
+    print('%-32s %s' % ('PatternMix', format_result(results['PatternMix'])))
+    return results, pattern_mix
+
+
+async def benchmark_encoders(args, led_config, pattern_mix):
+    results = {}
+    generator = types.SimpleNamespace(frames=FrameRing(led_config), stats=FrameStats())
+    generator.frames.publish(pattern_mix.colors, time.monotonic())
+    frame = generator.frames.latest
+
+    async def prepare_led_msgs():
+        for segment in frame.segments:
+            messages.PrepareLedMsg(segment.uid, segment.colors, messages.ColorFormat.RGB)
+    results['messages.PrepareLedMsg'] = await measure(
+        prepare_led_msgs, args.num_frames, args.num_memory_frames)
+
+    encoders = [messages.LedMsgEncoder(segment.uid, segment.num_leds, messages.ColorFormat.RGB)
+                for segment in frame.segments]
+
+    async def encode_led_msgs():
+        for encoder, segment in zip(encoders, frame.segments):
+            encoder.encode(segment.colors)
+    results['messages.LedMsgEncoder'] = await measure(
+        encode_led_msgs, args.num_frames, args.num_memory_frames)
+
+    # All segments on a single bus
+    bus_encoder = messages.LedBusEncoder(
+        [segment.uid for segment in frame.segments], [segment.num_leds for segment in frame.segments],
+        messages.Rgb565Lut(messages.ColorFormat.RGB))
+
+    async def encode_bus():
+        bus_encoder.encode(frame.colors)
+    results['messages.LedBusEncoder'] = await measure(
+        encode_bus, args.num_frames, args.num_memory_frames)
+
+    compressed_bus_encoder = messages.LedBusEncoder(
+        bus_encoder.uids, bus_encoder.num_leds, bus_encoder.lut, compress=True)
+
+    async def encode_compressed_bus():
+        compressed_bus_encoder.encode(frame.colors)
+    results['messages.LedBusEncoder(compress=True)'] = await measure(
+        encode_compressed_bus, args.num_frames, args.num_memory_frames)
+
+    opc = OpenPixelControlProtocol(
+        generator, name='benchmark', uids=[s.uid for s in frame.segments],
+        layout=BusLayout(led_config, list(range(len(frame.segments)))), on_con_lost=None)
+    opc.transport = NullTransport()
+    opc.send = opc.transport.write
+
+    async def put_pixels():
+        for channel, segment in enumerate(frame.segments):
+            opc.put_pixels(segment.colors, channel + 1)
+    results['OpenPixelControlProtocol.put_pixels'] = await measure(
+        put_pixels, args.num_frames, args.num_memory_frames)
+
+    # All channels of a single bus, as sent by OpenPixelControlProtocol.serve
+    opc_encoder = OpcBusEncoder(opc.channels, opc.layout.num_leds, lut=rgb_lut(output_levels()))
+
+    async def encode_opc_bus():
+        opc_encoder.encode(opc.layout.gather(frame.colors))
+    results['opc.OpcBusEncoder'] = await measure(
+        encode_opc_bus, args.num_frames, args.num_memory_frames)
+
+    dmx_udp_encoder = DmxUdpEncoder(
+        compile_universe_layout(opc.layout.num_leds, 1), lut=rgb_lut(output_levels()))
+
+    async def encode_dmx_udp_bus():
+        dmx_udp_encoder.encode(opc.layout.gather(frame.colors))
+    results['dmx_udp.DmxUdpEncoder'] = await measure(
+        encode_dmx_udp_bus, args.num_frames, args.num_memory_frames)
+
+    texture_server = TextureWebSocketsServer(generator)
+
+    async def prepare_texture_msg():
+        texture_server.PrepareTextureMsg(frame)
+    results['TextureWebSocketsServer.PrepareTextureMsg'] = await measure(
+        prepare_texture_msg, args.num_frames, args.num_memory_frames)
+
+    for texture_format in TEXTURE_FORMATS[1:]:
+        async def prepare_texture_msg_format():
+            texture_server.PrepareTextureMsg(frame, texture_format)
+        results['TextureWebSocketsServer.PrepareTextureMsg(%s)' % texture_format] = await measure(
+            prepare_texture_msg_format, args.num_frames, args.num_memory_frames)
+
+    for name, result in results.items():
+        print('%-32s %s' % (name.split('.')[-1], format_result(result)))
+    return results
+
+
+def format_result(result):
+    if 'error' in result:
+        return 'ERROR: %s' % result['error']
+    return '%8.3f ms/frame  %8.3f ms p95  %9.1f KiB/frame  %9.1f KiB peak' % (
+        result['ms_per_frame'], result['p95_ms'], result['alloc_kib_per_frame'], result['peak_kib'])
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """ Print the ms/frame ratio against the baseline.
+    Returns:
+     the number of benchmarks that regressed by more than threshold
+    """
+    regressions = 0
+    print('\nComparison to baseline (current / baseline ms/frame):')
+    for group in ('patterns', 'encoders'):
+        for name, result in results[group].items():
+            base = baseline.get(group, {}).get(name)
+            if not base or 'ms_per_frame' not in base or 'ms_per_frame' not in result:
+                continue
+            ratio = result['ms_per_frame'] / max(base['ms_per_frame'], 1e-9)
+            regressed = ratio > 1.0 + threshold
+            regressions += regressed
+            print('%-44s %6.2fx %s' % (name, ratio, 'REGRESSION' if regressed else ''))
+    return regressions
+
+
+async def main():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        description="Headless benchmark of all patterns, the pattern mix and the output encoders")
+    parser.add_argument("-l", "--led_config", type=argparse.FileType('r'),
+                        default="../config/led_config.json", help="LED config file")
+    parser.add_argument("-a", "--animation_rate", type=int, default=20,
+                        help="The target animation rate in Hz")
+    parser.add_argument("-n", "--num_frames", type=int, default=100,
+                        help="Number of frames to render per benchmark")
+    parser.add_argument("-m", "--num_memory_frames", type=int, default=20,
+                        help="Number of frames to render per benchmark while tracing memory")
+    parser.add_argument("-o", "--output", type=argparse.FileType('w'),
+                        help="Write the results as JSON to this file")
+    parser.add_argument("-b", "--baseline", type=argparse.FileType('r'),
+                        help="JSON results of a previous run to compare against")
+    parser.add_argument("-t", "--threshold", type=float, default=0.1,
+                        help="Relative slowdown against the baseline that counts as a regression")
+    args = parser.parse_args()
+    led_config = json.load(args.led_config)
+
+    print('Frame budget at %d Hz: %.1f ms\n' % (args.animation_rate, 1000.0 / args.animation_rate))
+    pattern_results, pattern_mix = await benchmark_patterns(args, led_config)
+    print()
+    encoder_results = await benchmark_encoders(args, led_config, pattern_mix)
+
+    results = {
+        'config': {
+            'num_frames': args.num_frames,
+            'animation_rate': args.animation_rate,
+            'total_num_leds': int(len(pattern_mix.colors)),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+        },
+        'patterns': pattern_results,
+        'encoders': encoder_results,
+    }
+    if args.output:
+        json.dump(results, args.output, indent=4)
+
+    if args.baseline:
+        regressions = compare_to_baseline(results, json.load(args.baseline), args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,69 @@
+# Send everything, no matter how long it takes
+POLICY_NONE = 'none'
+# Send as many segments as fit into the budget and continue with the next segment in the
+# following frame
+POLICY_ROUND_ROBIN = 'round_robin'
+# Drop frames while more than a frame worth of data is still queued for the bus
+POLICY_LATEST = 'latest'
+
+OVERLOAD_POLICIES = [POLICY_NONE, POLICY_ROUND_ROBIN, POLICY_LATEST]
+
+
+class BusBudget:
+    """ Per-frame byte budget of a serial bus, computed from its baudrate and frame rate. """
+
+    def __init__(self, baudrate, frame_rate, policy=POLICY_ROUND_ROBIN):
+        if policy not in OVERLOAD_POLICIES:
+            raise ValueError(f'Unknown overload policy: {policy}')
+        # 10 bits per byte on the wire including start and stop bit
+        self.bytes_per_frame = baudrate / 10 / frame_rate
+        self.policy = policy
+        # Last segment sent by round robin, the next frame continues after it
+        self.last_served = None
+
+        # Statistics
+        self.utilisation = 0.0
+        self.frames_dropped = 0
+        self.segments_deferred = 0
+
+    def select(self, segments, sizes, queued_bytes=0):
+        """ Selects the segments to send this frame.
+        Args:
+         segments: the segments of the bus in ascending bus order, e.g. their indices
+         sizes: the size in bytes of the message of each segment
+         queued_bytes: bytes from previous frames still waiting to be sent
+        Returns:
+         the list of segments to send
+        """
+        demand = sum(sizes)
+        self.utilisation = demand / self.bytes_per_frame
+
+        if self.policy == POLICY_LATEST:
+            if queued_bytes > self.bytes_per_frame:
+                self.frames_dropped += 1
+                return []
+            return segments
+
+        available = self.bytes_per_frame - queued_bytes
+        if self.policy == POLICY_NONE or demand <= available:
+            return segments
+
+        # Round robin: start after the last segment sent in the previous frame, so changes
+        # to the set of segments don't skip or repeat any, and send at least one segment
+        num_segments = len(segments)
+        start = 0
+        if self.last_served is not None:
+            start = next((i for i, segment in enumerate(segments)
+                          if segment > self.last_served), 0)
+        selected = []
+        used = 0
+        for i in range(num_segments):
+            index = (start + i) % num_segments
+            if selected and used + sizes[index] > available:
+                break
+            selected.append(segments[index])
+            used += sizes[index]
+        if selected:
+            self.last_served = selected[-1]
+        self.segments_deferred += num_segments - len(selected)
+        return selected
@@ -0,0 +1,60 @@
+import asyncio
+import collections
+import math
+import time
+
+
+class RecoveryScheduler:
+    """ Decides when a serial bus restarts LED controllers that are stuck in the bootloader.
+
+    Recovery interrupts the LED data of a bus, so it only runs when it is likely needed:
+    when a bus connects, every reboot_window_interval seconds during the reboot window
+    that follows, and every interval seconds after that. Periodic recoveries of different
+    buses are spread evenly over the interval and never run at the same time.
+    """
+
+    def __init__(self, interval=10.0, reboot_window=10.0, reboot_window_interval=1.0):
+        self.interval = interval
+        self.reboot_window = reboot_window
+        self.reboot_window_interval = reboot_window_interval
+        self.buses = []
+        self.next_times = {}
+        self.window_ends = {}
+        self.lock = asyncio.Lock()
+
+        # Statistics
+        self.recoveries = collections.Counter()
+
+    def register(self, name):
+        if name not in self.buses:
+            self.buses.append(name)
+            self.next_times[name] = math.inf
+            self.window_ends[name] = -math.inf
+
+    def request(self, name):
+        """ Recovers the bus as soon as possible and opens a new reboot window. """
+        now = time.monotonic()
+        self.next_times[name] = now
+        self.window_ends[name] = now + self.reboot_window
+
+    def is_due(self, name, now):
+        return now >= self.next_times[name]
+
+    async def run(self, name, recover):
+        """ Runs the recover coroutine function of a bus and schedules its next recovery. """
+        async with self.lock:
+            await recover()
+        self.recoveries[name] += 1
+
+        now = time.monotonic()
+        if now < self.window_ends[name]:
+            self.next_times[name] = self._next_slot(name, now, self.reboot_window_interval)
+        elif self.interval > 0:
+            self.next_times[name] = self._next_slot(name, now, self.interval)
+        else:
+            self.next_times[name] = math.inf
+
+    def _next_slot(self, name, now, interval):
+        # Every bus gets its own phase within the interval
+        phase = interval * self.buses.index(name) / len(self.buses)
+        return (math.floor((now - phase) / interval) + 1) * interval + phase
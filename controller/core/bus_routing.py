@@ -0,0 +1,72 @@
+import logging
+import numpy as np
+
+
+def compile_routing_table(led_config, bus_config):
+    """ Maps every bus to the indices of its segments in the frame.
+
+    Frame segments are in the order of the LED config, so the lookup of UIDs only
+    happens once at startup instead of for every bus in every frame.
+    Returns:
+     a dict from bus name to the list of segment indices, in the UID order of the bus
+    """
+    segment_indices = {s['uid']: i for i, s in enumerate(led_config['led_segments'])}
+    routing_table = {}
+    bus_names = {}
+    for bus in bus_config['led_busses']:
+        indices = []
+        for uid in bus['uids']:
+            if uid not in segment_indices:
+                logging.warning(f"Bus {bus['name']}: UID {uid} is not in the LED config, ignoring it.")
+                continue
+            if uid in bus_names:
+                logging.warning(f"Bus {bus['name']}: UID {uid} is also on bus {bus_names[uid]}.")
+            bus_names[uid] = bus['name']
+            indices.append(segment_indices[uid])
+        routing_table[bus['name']] = indices
+    return routing_table
+
+
+class BusLayout:
+    """ Order in which the LEDs of a bus are sent on the wire.
+
+    Segments in the LED config may have a physical_order that lists, for every LED on the
+    strip in the order it is wired, the index of the LED in the segment or -1 for LEDs that
+    are always off. This handles strips that are wired backwards, start somewhere in the
+    middle of the segment or have dead leading LEDs, without patterns knowing about it.
+    The whole bus is put into wire order with one precomputed gather.
+    """
+
+    def __init__(self, led_config, segment_indices):
+        led_segments = led_config['led_segments']
+        offsets = np.cumsum([0] + [s['num_leds'] for s in led_segments])
+        self.segment_indices = segment_indices
+        self.uids = []
+        # Number of LEDs on the wire per segment
+        self.num_leds = []
+        led_indices = []
+        for i in segment_indices:
+            segment = led_segments[i]
+            order = np.array(segment.get('physical_order', range(segment['num_leds'])), dtype=np.intp)
+            if len(order) and (order.min() < -1 or order.max() >= segment['num_leds']):
+                raise ValueError(f"Segment {segment['uid']}: physical_order is out of range")
+            if len(order) > 255:
+                raise ValueError(f"Segment {segment['uid']}: more than 255 LEDs can't be sent in one message")
+            self.uids.append(segment['uid'])
+            self.num_leds.append(len(order))
+            led_indices.append(np.where(order >= 0, offsets[i] + order, -1))
+        led_indices = np.concatenate(led_indices + [[]]).astype(np.intp)
+        self.off_leds = np.flatnonzero(led_indices < 0)
+        self.led_indices = np.maximum(led_indices, 0)
+        self.colors = np.zeros((len(led_indices), 3), dtype=np.uint8)
+
+    def gather(self, colors):
+        """ Puts the colors of a whole frame into wire order.
+        Returns:
+         a preallocated Nx3 array with the colors of all LEDs on the bus, valid until the
+         next call
+        """
+        np.take(colors, self.led_indices, axis=0, out=self.colors, mode='clip')
+        if len(self.off_leds):
+            self.colors[self.off_leds] = 0
+        return self.colors
@@ -0,0 +1,256 @@
+import asyncio
+import functools
+import logging
+import socket
+import uuid
+import numpy as np
+
+from core.frame_ring import FrameReader
+
+
+PROTOCOL_E131 = 'e131'
+PROTOCOL_ARTNET = 'artnet'
+PROTOCOLS = [PROTOCOL_E131, PROTOCOL_ARTNET]
+
+E131_PORT = 5568
+ARTNET_PORT = 6454
+
+DMX_UNIVERSE_SIZE = 512
+# RGB pixels never span two universes
+MAX_LEDS_PER_UNIVERSE = DMX_UNIVERSE_SIZE // 3
+
+E131_HEADER_SIZE = 126
+E131_SEQUENCE_OFFSET = 111
+E131_DEFAULT_PRIORITY = 100
+
+ARTNET_HEADER_SIZE = 18
+ARTNET_SEQUENCE_OFFSET = 12
+
+
+def E131Packet(universe, num_slots, source_name, cid, priority=E131_DEFAULT_PRIORITY):
+    """ Prepare an E1.31 (sACN) data packet with all slots set to 0.
+    Args:
+     universe: universe from 1 to 63999
+     num_slots: number of DMX slots
+     source_name: name of the source shown by receivers
+     cid: 16 byte component identifier of the source
+     priority: priority of the data from 0 to 200
+    Returns:
+     a uint8 array
+    """
+    size = E131_HEADER_SIZE + num_slots
+    packet = np.zeros(size, dtype=np.uint8)
+    header = bytearray()
+    # Root layer
+    header += (0x0010).to_bytes(2, 'big') + (0).to_bytes(2, 'big') + b'ASC-E1.17\0\0\0'
+    header += (0x7000 | (size - 16)).to_bytes(2, 'big') + (0x00000004).to_bytes(4, 'big') + cid
+    # Framing layer
+    header += (0x7000 | (size - 38)).to_bytes(2, 'big') + (0x00000002).to_bytes(4, 'big')
+    header += source_name.encode('utf-8')[:63].ljust(64, b'\0')
+    header += bytes([priority]) + (0).to_bytes(2, 'big') + bytes([0, 0]) + universe.to_bytes(2, 'big')
+    # DMP layer
+    header += (0x7000 | (size - 115)).to_bytes(2, 'big') + bytes([0x02, 0xa1])
+    header += (0).to_bytes(2, 'big') + (1).to_bytes(2, 'big') + (num_slots + 1).to_bytes(2, 'big')
+    # DMX start code
+    header += bytes([0])
+    packet[:E131_HEADER_SIZE] = np.frombuffer(bytes(header), dtype=np.uint8)
+    return packet
+
+
+def ArtDmxPacket(universe, num_slots):
+    """ Prepare an Art-Net ArtDmx packet with all slots set to 0.
+    Args:
+     universe: 15 bit port address, net, sub-net and universe
+     num_slots: number of DMX slots, rounded up to an even number as Art-Net requires
+    Returns:
+     a uint8 array
+    """
+    num_slots += num_slots % 2
+    packet = np.zeros(ARTNET_HEADER_SIZE + num_slots, dtype=np.uint8)
+    header = b'Art-Net\0' + (0x5000).to_bytes(2, 'little') + (14).to_bytes(2, 'big')
+    header += bytes([0, 0, universe & 0xFF, (universe >> 8) & 0x7F]) + num_slots.to_bytes(2, 'big')
+    packet[:ARTNET_HEADER_SIZE] = np.frombuffer(header, dtype=np.uint8)
+    return packet
+
+
+def compile_universe_layout(num_leds, start_universe, pack_segments=False):
+    """ Assigns the LEDs of a bus to universes.
+
+    By default every segment starts at a new universe, which is how most pixel controllers
+    map their outputs. With pack_segments, segments follow each other without gaps.
+    Returns:
+     a list with the universe, first LED on the bus and number of LEDs of every universe
+    """
+    layout = []
+    universe = start_universe
+    used = MAX_LEDS_PER_UNIVERSE
+    led = 0
+    for n in num_leds:
+        if not pack_segments:
+            used = MAX_LEDS_PER_UNIVERSE
+        while n:
+            if used == MAX_LEDS_PER_UNIVERSE:
+                if layout:
+                    universe += 1
+                layout.append([universe, led, 0])
+                used = 0
+            count = min(n, MAX_LEDS_PER_UNIVERSE - used)
+            layout[-1][2] += count
+            used += count
+            led += count
+            n -= count
+    return [tuple(entry) for entry in layout]
+
+
+class DmxUdpEncoder:
+    """ Encodes the universes of a bus into one preallocated buffer of E1.31 or Art-Net packets.
+
+    Like OpcBusEncoder, the headers are written once and every call to encode only fills in
+    the sequence numbers and the colors of the whole bus. The returned memoryviews are only
+    valid until the next call.
+    """
+
+    def __init__(self, universe_layout, protocol=PROTOCOL_E131, lut=None, source_name='funky_lights',
+                 cid=None, priority=E131_DEFAULT_PRIORITY):
+        if protocol not in PROTOCOLS:
+            raise ValueError(f'Unknown DMX over UDP protocol: {protocol}')
+        self.lut = lut
+        cid = cid or uuid.uuid4().bytes
+        if protocol == PROTOCOL_E131:
+            packets = [E131Packet(universe, n * 3, source_name, cid, priority) for universe, _, n in universe_layout]
+            header_size, sequence_offset = E131_HEADER_SIZE, E131_SEQUENCE_OFFSET
+            # E1.31 sequence numbers use all values, Art-Net uses 0 to disable them
+            self.sequence_values = 256
+        else:
+            packets = [ArtDmxPacket(universe, n * 3) for universe, _, n in universe_layout]
+            header_size, sequence_offset = ARTNET_HEADER_SIZE, ARTNET_SEQUENCE_OFFSET
+            self.sequence_values = 255
+        self.universes = [universe for universe, _, _ in universe_layout]
+        starts = np.cumsum([0] + [len(p) for p in packets[:-1]]).astype(np.intp)
+        self.buffer = np.concatenate(packets + [np.zeros(0, dtype=np.uint8)])
+        buffer = memoryview(self.buffer)
+        self.packets = [buffer[start:start + len(p)] for start, p in zip(starts, packets)]
+        self.sequence_positions = starts + sequence_offset
+        # Position of every color channel of every LED in the buffer
+        payload_positions = [
+            start + header_size + np.arange(n * 3).reshape(-1, 3)
+            for start, (_, _, n) in zip(starts, universe_layout)]
+        payload_positions = np.concatenate(payload_positions + [np.zeros((0, 3))]).astype(np.intp)
+        self.channel_positions = [np.ascontiguousarray(payload_positions[:, c]) for c in range(3)]
+        self.sequence = 0
+
+        # Scratch arrays
+        total_num_leds = len(payload_positions)
+        self.indices = np.zeros(total_num_leds, dtype=np.intp)
+        self.values = np.zeros(total_num_leds, dtype=np.uint8)
+
+    def encode(self, rgbs):
+        """ Encode a Nx3 array of RGB colors of all LEDs on the bus, in bus order.
+        Returns:
+         a list with a memoryview of the packet of every universe
+        """
+        self.sequence = self.sequence % self.sequence_values + 1
+        self.buffer[self.sequence_positions] = self.sequence % 256
+        for channel in range(3):
+            if self.lut is None:
+                self.buffer[self.channel_positions[channel]] = rgbs[:, channel]
+                continue
+            np.copyto(self.indices, rgbs[:, channel])
+            np.take(self.lut[channel], self.indices, out=self.values, mode='clip')
+            self.buffer[self.channel_positions[channel]] = self.values
+        return self.packets
+
+
+def E131MulticastAddress(universe):
+    return '239.255.%d.%d' % (universe >> 8, universe & 0xFF)
+
+
+async def connect_to_dmx_udp(generator, name, layout, config, lut=None):
+    """ Streams the frames of a bus as E1.31 or Art-Net universes.
+
+    config is the dmx_udp entry of the bus config. Without destinations, E1.31 universes go
+    to their multicast groups.
+    """
+    protocol = config.get('protocol', PROTOCOL_E131)
+    universe_layout = compile_universe_layout(
+        layout.num_leds, config.get('start_universe', 1 if protocol == PROTOCOL_E131 else 0),
+        config.get('pack_segments', False))
+    encoder = DmxUdpEncoder(
+        universe_layout, protocol, lut, source_name=config.get('source_name', 'funky_lights %s' % name),
+        priority=config.get('priority', E131_DEFAULT_PRIORITY))
+    port = config.get('port', E131_PORT if protocol == PROTOCOL_E131 else ARTNET_PORT)
+    destinations = config.get('destinations', [])
+    if not destinations and protocol != PROTOCOL_E131:
+        raise ValueError(f'Bus {name}: Art-Net needs destinations')
+
+    loop = asyncio.get_event_loop()
+    logging.info(f'Sending {len(universe_layout)} {protocol} universes of bus {name} to '
+                 f'{", ".join(destinations) or "multicast"}')
+    transport, sender = await loop.create_datagram_endpoint(
+        functools.partial(DmxUdpSender, generator=generator, name=name, layout=layout, encoder=encoder,
+                          destinations=[(d, port) for d in destinations], port=port),
+        family=socket.AF_INET, allow_broadcast=True)
+    if not destinations:
+        sock = transport.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, config.get('multicast_ttl', 1))
+        if 'multicast_interface' in config:
+            # Address of the local interface that the pixel controllers are connected to
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(config['multicast_interface']))
+    try:
+        await sender.on_con_lost
+    finally:
+        transport.close()
+
+
+class DmxUdpSender(asyncio.DatagramProtocol):
+    """ Sends every frame of a bus as one packet per universe and destination.
+
+    UDP has no backpressure to wait for. While packets of the previous frame are still waiting
+    for the socket, new frames are dropped.
+    """
+
+    def __init__(self, generator, name, layout, encoder, destinations, port):
+        super().__init__()
+        self.transport = None
+        self.generator = generator
+        self.name = name
+        self.frames = FrameReader(generator.frames)
+        self.layout = layout
+        self.encoder = encoder
+        # (packet index, address) of every packet of a frame
+        if destinations:
+            self.sends = [(i, d) for i in range(len(encoder.packets)) for d in destinations]
+        else:
+            self.sends = [(i, (E131MulticastAddress(u), port)) for i, u in enumerate(encoder.universes)]
+        self.on_con_lost = asyncio.get_event_loop().create_future()
+        self.errors = 0
+        self.frames_dropped = 0
+        self.stats = generator.stats
+        self.stats.add_counter('missed_frames/dmx_udp/%s' % name, lambda: self.frames.frames_missed)
+        self.stats.add_counter('dropped_frames/dmx_udp/%s' % name, lambda: self.frames_dropped)
+        self.stats.add_counter('errors/dmx_udp/%s' % name, lambda: self.errors)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        asyncio.ensure_future(self.serve())
+
+    def connection_lost(self, exc):
+        if not self.on_con_lost.done():
+            self.on_con_lost.set_result(True)
+
+    def error_received(self, exc):
+        self.errors += 1
+
+    async def serve(self):
+        while True:
+            frame = await self.frames.next()
+            if self.transport.is_closing():
+                break
+            if self.transport.get_write_buffer_size():
+                # The socket couldn't even take the previous frame
+                self.frames_dropped += 1
+                continue
+            with self.stats.timer('write/%s' % self.name):
+                packets = self.encoder.encode(self.layout.gather(frame.colors))
+                for i, address in self.sends:
+                    self.transport.sendto(packets[i], address)
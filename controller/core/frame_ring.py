@@ -0,0 +1,94 @@
+import asyncio
+import numpy as np
+
+
+DEFAULT_NUM_SLOTS = 4
+
+
+class FrameSegment:
+    def __init__(self, uid, num_leds, offset, colors):
+        self.uid = uid
+        self.num_leds = num_leds
+        self.offset = offset
+        self.colors = colors
+
+
+class Frame:
+    """ A preallocated, read-only slot of the frame ring.
+
+    colors is a (total_num_leds, 3) uint8 array and segments holds one read-only view
+    per LED segment in the order of the LED config.
+    """
+
+    def __init__(self, led_config):
+        total_num_leds = sum(s['num_leds'] for s in led_config['led_segments'])
+        self.number = -1
+        self.timestamp = 0.0
+        self.colors = np.zeros((total_num_leds, 3), dtype=np.ubyte)
+        self.segments = []
+        offset = 0
+        for s in led_config['led_segments']:
+            colors = self.colors[offset:offset + s['num_leds']]
+            colors.flags.writeable = False
+            self.segments.append(FrameSegment(s['uid'], s['num_leds'], offset, colors))
+            offset += s['num_leds']
+        self.colors.flags.writeable = False
+
+    def write(self, colors, number, timestamp):
+        self.colors.flags.writeable = True
+        np.copyto(self.colors, colors)
+        self.colors.flags.writeable = False
+        self.number = number
+        self.timestamp = timestamp
+
+
+class FrameRing:
+    """ Ring of preallocated frame slots with monotonically increasing frame numbers.
+
+    The generator publishes every animated frame into the next slot. Sinks always get
+    the latest frame. A slot is only reused after len(slots) - 1 newer frames, so sinks
+    must be done with a frame before that.
+    """
+
+    def __init__(self, led_config, num_slots=DEFAULT_NUM_SLOTS):
+        self.slots = [Frame(led_config) for _ in range(num_slots)]
+        self.frame_number = -1
+        self.new_frame = asyncio.Event()
+
+    @property
+    def latest(self):
+        if self.frame_number < 0:
+            return None
+        return self.slots[self.frame_number % len(self.slots)]
+
+    def publish(self, colors, timestamp):
+        number = self.frame_number + 1
+        self.slots[number % len(self.slots)].write(colors, number, timestamp)
+        self.frame_number = number
+        # Wake up all waiting sinks
+        self.new_frame.set()
+        self.new_frame.clear()
+
+    async def wait_for_frame(self, last_number=-1):
+        """ Returns the latest frame with a number greater than last_number. """
+        while self.frame_number <= last_number:
+            await self.new_frame.wait()
+        return self.latest
+
+
+class FrameReader:
+    """ Latest-frame-wins reader of a frame ring that counts the frames it missed. """
+
+    def __init__(self, frame_ring):
+        self.frame_ring = frame_ring
+        self.last_number = frame_ring.frame_number
+        self.frames_received = 0
+        self.frames_missed = 0
+
+    async def next(self):
+        frame = await self.frame_ring.wait_for_frame(self.last_number)
+        if self.frames_received:
+            self.frames_missed += frame.number - self.last_number - 1
+        self.last_number = frame.number
+        self.frames_received += 1
+        return frame
@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+
+# Skip all frame slots that have already passed and render the latest one
+POLICY_DROP = 'drop'
+# Render a single frame that advances the animation by the whole elapsed time
+POLICY_STRETCH = 'stretch'
+# Render missed frames back to back, up to a bounded number, then drop the rest
+POLICY_CATCH_UP = 'catch_up'
+
+FRAME_POLICIES = [POLICY_DROP, POLICY_STRETCH, POLICY_CATCH_UP]
+
+
+class FrameScheduler:
+    """ Drift-free frame scheduler based on time.monotonic().
+
+    Frame slots are placed at fixed multiples of the frame interval, so a late frame
+    never shifts the slots that follow it. A frame is late if it starts after its
+    whole slot has passed. What happens then is decided by the policy.
+    """
+
+    def __init__(self, rate, policy=POLICY_DROP, max_catch_up_frames=2):
+        if policy not in FRAME_POLICIES:
+            raise ValueError(f'Unknown frame policy: {policy}')
+        self.frame_interval = 1.0 / rate
+        self.policy = policy
+        self.max_catch_up_frames = max_catch_up_frames
+        self.next_frame_time = None
+        self.catch_up_budget = max_catch_up_frames
+        # Time of the current frame in the animation, the sum of all animation deltas
+        self.animation_time = 0.0
+
+        # Counters
+        self.frames_rendered = 0
+        self.frames_late = 0
+        self.frames_dropped = 0
+
+    async def wait_for_frame(self):
+        """ Waits until the next frame is due.
+        Returns:
+         the time in seconds the animation should advance for this frame
+        """
+        now = time.monotonic()
+        if self.next_frame_time is None:
+            self.next_frame_time = now
+
+        if now < self.next_frame_time:
+            await asyncio.sleep(self.next_frame_time - now)
+
+        delta = self.frame_interval
+        missed = int((now - self.next_frame_time) / self.frame_interval)
+        if missed <= 0:
+            self.catch_up_budget = self.max_catch_up_frames
+        else:
+            self.frames_late += 1
+            if self.policy == POLICY_CATCH_UP and self.catch_up_budget > 0:
+                self.catch_up_budget -= 1
+            else:
+                self.frames_dropped += missed
+                self.next_frame_time += missed * self.frame_interval
+                if self.policy == POLICY_STRETCH:
+                    delta += missed * self.frame_interval
+
+        self.next_frame_time += self.frame_interval
+        self.frames_rendered += 1
+        self.animation_time += delta
+        return delta
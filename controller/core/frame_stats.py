@@ -0,0 +1,61 @@
+import contextlib
+import numpy as np
+import time
+
+
+class Histogram:
+    """ Keeps a window of the most recent samples and reports their percentiles. """
+
+    def __init__(self, window_size=200):
+        self.samples = np.zeros(window_size)
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.count % len(self.samples)] = value
+        self.count += 1
+
+    def to_dict(self):
+        samples = self.samples[:min(self.count, len(self.samples))]
+        if not len(samples):
+            return {'count': 0}
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+        return {
+            'count': self.count,
+            'mean': float(np.mean(samples)),
+            'p50': float(p50),
+            'p95': float(p95),
+            'p99': float(p99),
+            'max': float(np.max(samples)),
+        }
+
+
+class FrameStats:
+    """ Per-stage frame timings in milliseconds plus a set of counters. """
+
+    def __init__(self, window_size=200):
+        self.window_size = window_size
+        self.histograms = {}
+        self.counters = {}
+
+    def add(self, name, value_ms):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(self.window_size)
+        self.histograms[name].add(value_ms)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000)
+
+    def add_counter(self, name, get_value):
+        """ Registers a counter. get_value is called whenever the stats are exported. """
+        self.counters[name] = get_value
+
+    def to_dict(self):
+        return {
+            'timings_ms': {name: h.to_dict() for name, h in sorted(self.histograms.items())},
+            'counters': {name: get_value() for name, get_value in sorted(self.counters.items())},
+        }
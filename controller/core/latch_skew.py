@@ -0,0 +1,37 @@
+import collections
+
+
+class LatchSkew:
+    """ Measures how far apart in time the buses show the same frame.
+
+    Every bus reports when the latch after the LED data of a frame is expected to leave the
+    wire. Once all buses reported a frame, the spread of those times is the skew between the
+    buses. Frames that some buses skipped are forgotten after max_pending_frames.
+    """
+
+    def __init__(self, stats, max_pending_frames=8):
+        self.stats = stats
+        self.max_pending_frames = max_pending_frames
+        self.buses = []
+        # Frame number -> {bus name: expected latch time}
+        self.latch_times = collections.OrderedDict()
+
+        # Statistics
+        self.frames_incomplete = 0
+        self.stats.add_counter('incomplete_latch_frames', lambda: self.frames_incomplete)
+
+    def register(self, name):
+        if name not in self.buses:
+            self.buses.append(name)
+
+    def add(self, name, frame, latch_time):
+        """ Reports the expected time at which bus name latches frame. """
+        self.stats.add('latch_delay/%s' % name, (latch_time - frame.timestamp) * 1000)
+        times = self.latch_times.setdefault(frame.number, {})
+        times[name] = latch_time
+        if len(times) == len(self.buses):
+            del self.latch_times[frame.number]
+            self.stats.add('latch_skew', (max(times.values()) - min(times.values())) * 1000)
+        while len(self.latch_times) > self.max_pending_frames:
+            self.latch_times.popitem(last=False)
+            self.frames_incomplete += 1
@@ -1,26 +1,48 @@
 import asyncio
+import collections
 import functools
 import logging
-import struct
-import sys
-import traceback
+import numpy as np
+import socket
+import time
 
+from core.frame_ring import FrameReader
 
-async def connect_to_opc(generator, uids, server_ip, server_port):
+
+# Set pixel colors, from openpixelcontrol.org
+CMD_SET_PIXEL_COLORS = 0
+
+# Largest payload of a UDP datagram
+MAX_UDP_PAYLOAD_SIZE = 65507
+
+PROTOCOL_TCP = 'tcp'
+PROTOCOL_UDP = 'udp'
+
+
+async def connect_to_opc(generator, name, uids, layout, server_ip, server_port, lut=None,
+                         protocol=PROTOCOL_TCP, coalesce_channels=True):
     reconnect_interval = 5.0  # In seconds
     loop = asyncio.get_event_loop()
     while True:
         on_con_lost = loop.create_future()
 
         logging.info(
-            f'Connecting to OPC server at {server_ip}:{server_port}')
+            f'Connecting to OPC server at {server_ip}:{server_port} ({protocol})')
         opc_factory = functools.partial(
             OpenPixelControlProtocol,
             generator=generator,
+            name=name,
             uids=uids,
-            on_con_lost=on_con_lost)
+            layout=layout,
+            lut=lut,
+            on_con_lost=on_con_lost,
+            coalesce_channels=coalesce_channels)
         try:
-            transport, protocol = await loop.create_connection(opc_factory, server_ip, server_port)
+            if protocol == PROTOCOL_UDP:
+                transport, _ = await loop.create_datagram_endpoint(
+                    opc_factory, remote_addr=(server_ip, server_port))
+            else:
+                transport, _ = await loop.create_connection(opc_factory, server_ip, server_port)
         except Exception as exc:
             logging.warn(
                 f'Could not connect to OPC server: {exc}. Retrying in {reconnect_interval} seconds.')
@@ -38,14 +60,114 @@ async def connect_to_opc(generator, uids, server_ip, server_port):
         await asyncio.sleep(reconnect_interval)
 
 
+def OpcMsg(channel, pixels):
+    """ Build a set pixel colors message.
+    Args:
+     channel: OPC channel, 0 addresses all channels
+     pixels: Nx3 array of RGB colors. Floats are rounded down and values outside of 0-255
+         are clamped.
+    Returns:
+     bytes, ready to send to the OPC server
+    """
+    pixels = np.asarray(pixels)
+    if pixels.dtype != np.uint8:
+        pixels = np.clip(pixels, 0, 255).astype(np.uint8)
+    size = pixels.size
+    header = bytes([channel, CMD_SET_PIXEL_COLORS, size >> 8, size & 0xFF])
+    return header + pixels.tobytes()
+
+
+class OpcBusEncoder:
+    """ Encodes the OPC messages of all channels of a bus into one preallocated buffer.
+
+    Like LedBusEncoder, the headers are written once and every call to encode only fills in
+    the colors of the whole bus. The returned memoryviews are only valid until the next call.
+    """
+
+    def __init__(self, channels, num_leds, lut=None):
+        self.lut = lut
+        sizes = [4 + n * 3 for n in num_leds]
+        starts = np.cumsum([0] + sizes[:-1]).astype(np.intp)
+        self.buffer = np.zeros(sum(sizes), dtype=np.uint8)
+        buffer = memoryview(self.buffer)
+        self.msgs = []
+        payload_positions = []
+        for channel, n, start, size in zip(channels, num_leds, starts, sizes):
+            self.buffer[start:start + 4] = [channel, CMD_SET_PIXEL_COLORS, (n * 3) >> 8, (n * 3) & 0xFF]
+            self.msgs.append(buffer[start:start + size])
+            payload_positions.append(np.arange(start + 4, start + size).reshape(-1, 3))
+        # Position of every color channel of every LED in the buffer
+        self.payload_positions = np.concatenate(payload_positions + [np.zeros((0, 3))]).astype(np.intp)
+        self.channel_positions = [np.ascontiguousarray(self.payload_positions[:, c]) for c in range(3)]
+
+        # Scratch arrays
+        total_num_leds = sum(num_leds)
+        self.indices = np.zeros(total_num_leds, dtype=np.intp)
+        self.values = np.zeros(total_num_leds, dtype=np.uint8)
+
+    def encode(self, rgbs):
+        """ Encode a Nx3 array of RGB colors of all LEDs on the bus, in bus order.
+        Returns:
+         a list with a memoryview of the message of every channel
+        """
+        if self.lut is None:
+            self.buffer[self.payload_positions] = rgbs
+            return self.msgs
+        for channel in range(3):
+            np.copyto(self.indices, rgbs[:, channel])
+            np.take(self.lut[channel], self.indices, out=self.values, mode='clip')
+            self.buffer[self.channel_positions[channel]] = self.values
+        return self.msgs
+
 
 class OpenPixelControlProtocol(asyncio.Protocol):
-    def __init__(self, generator, uids, on_con_lost):
+    """ Sends the frames of a bus to an OPC server over TCP or UDP.
+
+    With coalesce_channels, the messages of all channels of a frame are sent in a single
+    write, or in as few datagrams as possible over UDP. Otherwise every channel gets its own
+    write.
+
+    Writing pauses once more than high_water_frames frames are waiting in the write buffer and
+    resumes when at most low_water_frames are left. Frames rendered in the meantime are
+    dropped and writing resumes with the newest frame, so a slow server doesn't make the
+    latency grow.
+    """
+
+    def __init__(self, generator, name, uids, layout, on_con_lost, lut=None, coalesce_channels=True,
+                 high_water_frames=2, low_water_frames=1):
         super().__init__()
         self.transport = None
+        self.send = None
         self.opc = None
         self.generator = generator
+        self.name = name
+        self.frames = FrameReader(generator.frames)
+        self.stats = generator.stats
+        self.stats.add_counter('missed_frames/opc/%s' % name, lambda: self.frames.frames_missed)
         self.uids = uids
+        self.layout = layout
+        # OPC channels are numbered by the position of the UID in the bus config
+        self.channels = [uids.index(uid) + 1 for uid in layout.uids]
+        # Optional 3x256 lookup table with gamma, dimming and color balance
+        self.encoder = OpcBusEncoder(self.channels, layout.num_leds, lut)
+        self.coalesce_channels = coalesce_channels
+        # Byte ranges of the encoder buffer sent with each write
+        self.writes = []
+        # Cleared while the transport's write buffer is above its high-water mark
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+        self.high_water_frames = high_water_frames
+        self.low_water_frames = low_water_frames
+        # Total bytes written and (end in bytes written, timestamp) of every frame that may
+        # still be in the write buffer, to measure how long frames wait in the buffer
+        self.bytes_written = 0
+        self.queued_frames = collections.deque()
+        self.errors = 0
+        self.frames_dropped = 0
+        self.stats.add_counter('errors/opc/%s' % name, lambda: self.errors)
+        self.stats.add_counter('dropped_frames/opc/%s' % name, lambda: self.frames_dropped)
+        self.stats.add_counter('write_buffer_bytes/opc/%s' % name,
+                               lambda: self.transport.get_write_buffer_size() if self.transport else 0)
         self.verbose = False
         self.on_con_lost = on_con_lost
 
@@ -57,11 +179,72 @@ class OpenPixelControlProtocol(asyncio.Protocol):
         """Store the OpenPixelControl transport and schedule the task to send data.
         """
         self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None and sock.type == socket.SOCK_DGRAM:
+            # The transport is connected to the server, so datagrams need no address
+            self.send = transport.sendto
+            max_write_size = MAX_UDP_PAYLOAD_SIZE
+        else:
+            self.send = transport.write
+            max_write_size = float('inf')
+        self.writes = self._group_writes(
+            [len(msg) for msg in self.encoder.msgs], max_write_size if self.coalesce_channels else 0)
+        frame_size = len(self.encoder.buffer)
+        transport.set_write_buffer_limits(
+            high=self.high_water_frames * frame_size, low=self.low_water_frames * frame_size)
+        if sock is not None and sock.type == socket.SOCK_STREAM:
+            # A large kernel send buffer would hide a slow server from the watermarks
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.high_water_frames * frame_size)
         asyncio.ensure_future(self.serve())
 
     def connection_lost(self, exc):
         print('OpenPixelControlProtocol closed')
-        self.on_con_lost.set_result(True)
+        # Wake up serve, so it notices that the transport is closed
+        self.can_write.set()
+        if not self.on_con_lost.done():
+            self.on_con_lost.set_result(True)
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+        self._update_queue_latency()
+
+    def _update_queue_latency(self):
+        """ Reports the time from rendering to leaving the write buffer of every frame that
+        left the write buffer since the last call.
+        """
+        bytes_sent = self.bytes_written - self.transport.get_write_buffer_size()
+        now = time.monotonic()
+        while self.queued_frames and self.queued_frames[0][0] <= bytes_sent:
+            _, timestamp = self.queued_frames.popleft()
+            self.stats.add('queue_latency/opc/%s' % self.name, (now - timestamp) * 1000)
+
+    def datagram_received(self, data, addr):
+        pass
+
+    def error_received(self, exc):
+        # E.g. nothing listens on the port of the server. Keep sending, it may come up later.
+        self.errors += 1
+        self._debug('error_received: %s' % exc)
+
+    @staticmethod
+    def _group_writes(sizes, max_write_size):
+        """ Groups consecutive messages into writes of at most max_write_size bytes. A message
+        that is larger than max_write_size gets a write of its own.
+        Returns:
+         a list of (start, end) byte ranges
+        """
+        writes = []
+        position = 0
+        for size in sizes:
+            if writes and position + size - writes[-1][0] <= max_write_size:
+                writes[-1] = (writes[-1][0], position + size)
+            else:
+                writes.append((position, position + size))
+            position += size
+        return writes
 
     def put_pixels(self, pixels, channel=0):
         """Send the list of pixel colors to the OPC server on the given channel.
@@ -70,14 +253,12 @@ class OpenPixelControlProtocol(asyncio.Protocol):
             Must be an int in the range 0-255 inclusive.
             0 is a special value which means "all channels".
 
-        pixels: A list of 3-tuples representing rgb colors.
+        pixels: A list of 3-tuples or Nx3 array representing rgb colors.
             Each value in the tuple should be in the range 0-255 inclusive. 
             For example: [(255, 255, 255), (0, 0, 0), (127, 0, 0)]
             Floats will be rounded down to integers.
             Values outside the legal range will be clamped.
 
-        Will establish a connection to the server as needed.
-
         On successful transmission of pixels, return True.
         On failure (bad connection), return False.
 
@@ -86,41 +267,33 @@ class OpenPixelControlProtocol(asyncio.Protocol):
         LED at a time (unless it's the first one).
 
         """
-        self._debug('put_pixels: connecting')
-        is_closing = self.transport.is_closing()
-        if is_closing:
+        if self.transport.is_closing():
             self._debug('put_pixels: not connected.  ignoring these pixels.')
             return False
 
-        # build OPC message
-        len_hi_byte = int(len(pixels)*3 / 256)
-        len_lo_byte = (len(pixels)*3) % 256
-        command = 0  # set pixel colors from openpixelcontrol.org
-
-        header = struct.pack("BBBB", channel, command,
-                             len_hi_byte, len_lo_byte)
-
-        pieces = [struct.pack("BBB",
-                              min(255, max(0, int(r))),
-                              min(255, max(0, int(g))),
-                              min(255, max(0, int(b)))) for r, g, b in pixels]
-
-        if sys.version_info[0] == 3:
-            # bytes!
-            message = header + b''.join(pieces)
-        else:
-            # strings!
-            message = header + ''.join(pieces)
-
         self._debug('put_pixels: sending pixels to server')
-        self.transport.write(message)
-
+        self.send(OpcMsg(channel, pixels))
         return True
 
     async def serve(self):
         while True:
-            segments = await asyncio.shield(self.generator.result)
-            for segment in segments:
-                if segment.uid in self.uids:
-                    channel = self.uids.index(segment.uid) + 1
-                    self.put_pixels(segment.colors, channel)
+            # Frames rendered while the server is behind are dropped. The frame reader
+            # returns the newest frame once writing resumes.
+            paused = not self.can_write.is_set()
+            await self.can_write.wait()
+            frames_missed = self.frames.frames_missed
+            frame = await self.frames.next()
+            if paused:
+                self.frames_dropped += self.frames.frames_missed - frames_missed
+            if self.transport.is_closing():
+                break
+            self._update_queue_latency()
+            with self.stats.timer('write/%s' % self.name):
+                self.encoder.encode(self.layout.gather(frame.colors))
+                for start, end in self.writes:
+                    # The transport may keep the data until it is sent, so it gets a copy of
+                    # the reused encoder buffer
+                    self.send(self.encoder.buffer[start:end].tobytes())
+                self.bytes_written += len(self.encoder.buffer)
+                self.queued_frames.append((self.bytes_written, frame.timestamp))
+            self._update_queue_latency()
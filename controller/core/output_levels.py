@@ -0,0 +1,23 @@
+import numpy as np
+
+
+def output_levels(gamma=1.0, brightness=1.0, color_balance=(1.0, 1.0, 1.0)):
+    """ Output level of every input value per channel, with gamma correction, the master
+    dimmer and the color balance of a bus applied.
+
+    The levels are folded into the lookup tables of the output encoders, so they cost
+    nothing per frame.
+    Returns:
+     a 3x256 float array with levels from 0 to 255 for the red, green and blue channel
+    """
+    values = np.arange(256) / 255.0
+    scale = brightness * np.asarray(color_balance, dtype=float).reshape(3, 1)
+    return np.clip(255.0 * scale * values ** gamma, 0, 255)
+
+
+def rgb_lut(levels):
+    """ Lookup tables for outputs that take 8 bit RGB, like OPC.
+    Returns:
+     a 3x256 uint8 array. The output color of (r, g, b) is lut[[0, 1, 2], (r, g, b)].
+    """
+    return np.rint(levels).astype(np.uint8)
@@ -54,7 +54,7 @@ class CachedPattern(Pattern):
             bytes = await afp.read()
             segment_colors = pickle.loads(bytes)
             for i, segment in enumerate(self.segments):
-                segment.colors = segment_colors[i]
+                segment.colors[:] = segment_colors[i]
 
         self.current_animation_index = (self.current_animation_index + 1) % self.num_animation_steps
 
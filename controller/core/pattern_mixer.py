@@ -1,5 +1,7 @@
+import asyncio
 from patterns.pattern import Pattern
 import numpy as np
+import time
 
 class PatternMix(Pattern):
     def __init__(self, patterns, pattern_cache):
@@ -9,6 +11,9 @@ class PatternMix(Pattern):
         self.base_patterns = []
         self.mix_patterns = []
         self.replace_patterns = []
+        # Optional FrameStats for per-layer timings
+        self.stats = None
+        self.layer_names = {}
 
     def get_patterns_from_id(self, pattern_ids):
         selected_patterns = []
@@ -20,53 +25,80 @@ class PatternMix(Pattern):
         return selected_patterns
 
     def update_mix(self, base_pattern_ids, replace_pattern_ids, mix_pattern_ids):
+        for pattern_ids in (base_pattern_ids, replace_pattern_ids, mix_pattern_ids):
+            for pattern_id, pattern in zip(pattern_ids, self.get_patterns_from_id(pattern_ids)):
+                self.layer_names[pattern] = pattern_id
         self.base_pattern_ids = self.get_patterns_from_id(base_pattern_ids)
         self.replace_patterns = self.get_patterns_from_id(replace_pattern_ids)
         self.mix_patterns = self.get_patterns_from_id(mix_pattern_ids)
 
+    def prepareSegments(self, led_config, colors=None):
+        super().prepareSegments(led_config, colors)
+        # Scratch buffer for the saturating add of the mix patterns
+        self.tmp_colors = np.zeros_like(self.colors)
+        # Cache of frame buffer indices covered by each pattern
+        self.composite_indices = {}
+
+    def get_composite_indices(self, pattern, included_only):
+        """ Returns the indices into the frame buffer that pattern writes to when
+            composited. Segment masks are honoured. A full slice is returned if
+            the pattern covers the whole frame.
+        """
+        key = (id(pattern), included_only)
+        if key in self.composite_indices:
+            return self.composite_indices[key]
+
+        segments = pattern.getSegments() if included_only else pattern.segments
+        ranges = []
+        for segment in segments:
+            start = segment.offset
+            end = segment.offset + segment.num_leds
+            if segment.mask:
+                m = segment.mask
+                start, end = start + m.start, min(start + m.end, end)
+            ranges.append(np.arange(start, end))
+        indices = np.concatenate(ranges) if ranges else np.arange(0)
+        if np.array_equal(indices, np.arange(len(self.colors))):
+            indices = slice(None)
+        self.composite_indices[key] = indices
+        return indices
+
+    async def animate_layer(self, pattern, delta):
+        start = time.perf_counter()
+        await pattern.animate(delta)
+        if self.stats:
+            self.stats.add('animate/%s' % self.layer_names.get(pattern, type(pattern).__name__),
+                           (time.perf_counter() - start) * 1000)
+
     async def animate(self, delta):
+        # Animate all layers concurrently. This lets patterns rendered in worker
+        # processes run in parallel.
+        layers = dict.fromkeys(self.base_pattern_ids + self.replace_patterns + self.mix_patterns)
+        await asyncio.gather(*[self.animate_layer(pattern, delta) for pattern in layers])
+
+        start = time.perf_counter()
+        self.composite()
+        if self.stats:
+            self.stats.add('composite', (time.perf_counter() - start) * 1000)
+
+    def composite(self):
         # Zero out colors
-        for segment in self.segments:
-            segment.colors[:] = 0
+        self.colors[:] = 0
 
         # Base
         for pattern in self.base_pattern_ids:
-            await pattern.animate(delta)
-            for segment, mix_segment in zip(self.segments, pattern.segments):
-                if mix_segment.mask:
-                    # Mask available, copy masked LEDs only
-                    m = mix_segment.mask
-                    segment.colors[m.start:m.end] = mix_segment.colors[m.start:m.end]
-                else:
-                    # No mask, copy everything
-                    np.copyto(segment.colors, mix_segment.colors)
+            indices = self.get_composite_indices(pattern, included_only=False)
+            self.colors[indices] = pattern.colors[indices]
 
         # Replace
         for pattern in self.replace_patterns:
-            await pattern.animate(delta)
-            included_segments = list(pattern.getSegments())
-            for segment, mix_segment in zip(self.segments, pattern.segments):
-                if mix_segment in included_segments:
-                    if mix_segment.mask:
-                        # Mask available, copy masked LEDs only
-                        m = mix_segment.mask
-                        segment.colors[m.start:m.end] = mix_segment.colors[m.start:m.end]
-                    else:
-                        # No mask, copy everything
-                        np.copyto(segment.colors, mix_segment.colors)
+            indices = self.get_composite_indices(pattern, included_only=True)
+            self.colors[indices] = pattern.colors[indices]
 
         # Mix
         for pattern in self.mix_patterns:
-            await pattern.animate(delta)
-            for segment, mix_segment in zip(self.segments, pattern.segments):
-                tmp = 255 - mix_segment.colors  # a temp uint8 array here
-                np.putmask(segment.colors, tmp < segment.colors, tmp)  # a temp bool array here
-                if mix_segment.mask:
-                    # Mask available, copy masked LEDs only
-                    m = mix_segment.mask
-                    segment.colors[m.start:m.end] += mix_segment.colors[m.start:m.end]
-                else:
-                    # No mask, copy everything
-                    segment.colors += mix_segment.colors
-
-
+            # Saturating add: clamp to 255 - mix color first so the sum can't overflow
+            np.subtract(255, pattern.colors, out=self.tmp_colors)
+            np.minimum(self.colors, self.tmp_colors, out=self.colors)
+            indices = self.get_composite_indices(pattern, included_only=False)
+            self.colors[indices] += pattern.colors[indices]
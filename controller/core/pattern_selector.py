@@ -1,6 +1,7 @@
 import asyncio
 import functools
 import json
+import logging
 import lpminimk3
 import time
 import serial
@@ -9,6 +10,8 @@ import websockets
 
 from core.pattern_cache import PatternCache
 from core.pattern_mixer import PatternMix
+from core.pattern_worker import PatternRenderPool
+from core.websockets import PATTERN_MIX_HEARTBEAT_INTERVAL
 
 def run_in_executor(f):
     @functools.wraps(f)
@@ -47,6 +50,12 @@ class PatternSelector:
         else:
             self.pattern_cache = None
 
+        # Pool of worker processes for rendering patterns
+        if args.render_processes > 0:
+            self.render_pool = PatternRenderPool(args.render_processes, led_config)
+        else:
+            self.render_pool = None
+
         # Dict of all patterns
         self.patterns = {}
 
@@ -59,7 +68,8 @@ class PatternSelector:
 
         # Pattern rotation and related
         self.current_pattern_id = self.pattern_rotation[0]
-        self.pattern_start_time = time.time()
+        # Pattern times are animation times of the frame scheduler, which start at 0
+        self.pattern_start_time = 0.0
         self.pattern_rotation_index = 0
         self.current_pattern_eye_id = self.pattern_eyes[0]
         self.current_effect_pattern_ids = []
@@ -115,8 +125,14 @@ class PatternSelector:
 
 
     async def initializePatterns(self):
+        # Initialize all patterns in worker processes
+        if self.render_pool:
+            self.patterns.update(await self.render_pool.start(self.all_patterns_configs()))
+
         # Initialize all patterns
         for pattern_id, (cls, params) in self.all_patterns_configs():
+            if pattern_id in self.patterns:
+                continue
             pattern = cls()
             for key in params:
                 setattr(pattern.params, key, params[key])
@@ -391,11 +407,31 @@ class PatternSelector:
 
 
     async def patternMixWSListener(self, uri):
+        """ Follows the pattern mix of a PatternMixWebSocketsServer.
+
+        Reconnects to get a new snapshot if the publisher goes quiet for longer than a few
+        heartbeats or a message doesn't follow the last sequence number.
+        """
+        timeout = 3 * PATTERN_MIX_HEARTBEAT_INTERVAL
         async for websocket in websockets.connect(uri):
+            pattern_mix = None
+            sequence = None
             try:
-                res = await websocket.recv()
-                pattern_mix = json.loads(res)
-                self.pattern_mix_updates.append(pattern_mix)
+                while True:
+                    msg = json.loads(await asyncio.wait_for(websocket.recv(), timeout))
+                    if msg.get('type') == 'snapshot':
+                        pattern_mix = msg['pattern_mix']
+                    elif msg.get('type') == 'delta' and msg['base'] == sequence:
+                        pattern_mix = dict(pattern_mix, **msg['changes'])
+                    elif msg.get('type') == 'heartbeat' and msg['sequence'] == sequence:
+                        continue
+                    else:
+                        logging.warning(f"Pattern mix {msg.get('type')} {msg.get('sequence')} doesn't follow {sequence}, reconnecting")
+                        break
+                    sequence = msg['sequence']
+                    self.pattern_mix_updates.append(pattern_mix)
+            except asyncio.TimeoutError:
+                logging.warning(f'No pattern mix heartbeat from {uri}, reconnecting')
             except websockets.ConnectionClosed:
                 continue
 
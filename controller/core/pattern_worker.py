@@ -0,0 +1,233 @@
+import asyncio
+import atexit
+import collections
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import traceback
+
+from patterns.pattern import Pattern
+
+
+CMD_ANIMATE = 'animate'
+CMD_RESET = 'reset'
+
+# Error of the requests to a worker process that died
+WORKER_DIED = 'Worker process died'
+
+
+def frame_buffer_size(led_config):
+    return sum(s['num_leds'] for s in led_config['led_segments']) * 3
+
+
+def shared_frame_buffer(shm, led_config):
+    """ Returns a (total_num_leds, 3) uint8 view into a shared memory block. """
+    num_leds = frame_buffer_size(led_config) // 3
+    return np.ndarray((num_leds, 3), dtype=np.ubyte, buffer=shm.buf)
+
+
+def worker_main(conn, led_config, pattern_configs):
+    """ Entry point of a pattern worker process.
+
+    Instantiates the given patterns with their frame buffers in shared memory and then
+    executes animate and reset requests sent over conn, one at a time and in order.
+    The first message is a dict of pattern_id to formatted traceback of the patterns that
+    failed to initialize. Every request is answered with None on success or a formatted
+    traceback on failure.
+    """
+    shms = []
+    patterns = {}
+    errors = {}
+    for pattern_id, (cls, params, shm_name) in pattern_configs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        shms.append(shm)
+        try:
+            pattern = cls()
+            for key in params:
+                setattr(pattern.params, key, params[key])
+            pattern.prepareSegments(led_config, colors=shared_frame_buffer(shm, led_config))
+            pattern.initialize()
+            patterns[pattern_id] = pattern
+        except Exception:
+            errors[pattern_id] = traceback.format_exc()
+    conn.send(errors)
+
+    loop = asyncio.new_event_loop()
+    while True:
+        try:
+            cmd, pattern_id, delta = conn.recv()
+        except EOFError:
+            break
+        try:
+            if cmd == CMD_ANIMATE:
+                loop.run_until_complete(patterns[pattern_id].animate(delta))
+            elif cmd == CMD_RESET:
+                patterns[pattern_id].reset()
+            conn.send(None)
+        except Exception:
+            conn.send(traceback.format_exc())
+
+
+class PatternWorker:
+    """ Main process handle of a single worker process.
+
+    If the worker process dies, all pending requests are answered with an error and the
+    worker is marked as dead. Requests to a dead worker fail right away.
+    """
+
+    def __init__(self, context, led_config, pattern_configs):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=worker_main, args=(child_conn, led_config, pattern_configs), daemon=True)
+        self.pending = collections.deque()
+        self.loop = None
+        self.alive = True
+        # Patterns that failed to initialize in the worker process
+        self.failed = set()
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        # The worker answers with a first message once all patterns are initialized
+        ready = self.loop.create_future()
+        self.pending.append(ready)
+        self.process.start()
+        self.loop.add_reader(self.conn.fileno(), self.on_readable)
+        errors = await ready
+        if errors is WORKER_DIED:
+            return
+        for pattern_id, error in errors.items():
+            logging.error(f'Failed to initialize pattern {pattern_id} in worker process, '
+                          f'it stays dark:\n{error}')
+        self.failed = set(errors)
+
+    def request(self, cmd, pattern_id, delta=None):
+        future = asyncio.get_running_loop().create_future()
+        if not self.alive:
+            future.set_result(WORKER_DIED)
+            return future
+        self.pending.append(future)
+        try:
+            self.conn.send((cmd, pattern_id, delta))
+        except OSError:
+            self.on_died()
+        return future
+
+    def on_readable(self):
+        try:
+            while self.conn.poll():
+                error = self.conn.recv()
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_result(error)
+        except (EOFError, OSError):
+            self.on_died()
+
+    def on_died(self):
+        if not self.alive:
+            return
+        self.alive = False
+        logging.error(f'Pattern worker process {self.process.pid} died with exit code '
+                      f'{self.process.exitcode}, its patterns keep their last frame')
+        self.stop()
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_result(WORKER_DIED)
+
+    def stop(self):
+        self.alive = False
+        if self.loop and not self.conn.closed:
+            self.loop.remove_reader(self.conn.fileno())
+            self.conn.close()
+
+
+class RemotePattern(Pattern):
+    """ Stand-in for a pattern that is rendered in a worker process.
+
+    The frame buffer is shared with the worker, so after animate returns self.colors
+    holds the worker's latest frame without any copies. Once the worker died, self.colors
+    keeps the last frame it rendered. Patterns that failed to initialize in the worker
+    are never requested and stay dark.
+    """
+
+    def __init__(self, worker, pattern_id):
+        super().__init__()
+        self.worker = worker
+        self.pattern_id = pattern_id
+
+    @property
+    def active(self):
+        return self.worker.alive and self.pattern_id not in self.worker.failed
+
+    def reset(self):
+        if self.active:
+            self.worker.request(CMD_RESET, self.pattern_id)
+
+    async def animate(self, delta):
+        if not self.active:
+            return
+        error = await self.worker.request(CMD_ANIMATE, self.pattern_id, delta)
+        if error and error is not WORKER_DIED:
+            logging.error(f'Pattern {self.pattern_id} failed in worker process:\n{error}')
+
+
+class PatternRenderPool:
+    """ Renders patterns in a pool of worker processes into shared memory frames. """
+
+    def __init__(self, num_processes, led_config):
+        self.num_processes = num_processes
+        self.led_config = led_config
+        # Use spawn so workers don't inherit the event loop, serial ports or threads
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = []
+        self.shms = []
+
+    async def start(self, pattern_configs):
+        """ Start the workers and distribute the patterns across them round-robin.
+        Args:
+         pattern_configs: iterable of (pattern_id, (cls, params)) tuples
+        Returns:
+         a dict of pattern_id to RemotePattern
+        """
+        atexit.register(self.close)
+        worker_configs = [{} for _ in range(self.num_processes)]
+        pattern_workers = {}
+        for i, (pattern_id, (cls, params)) in enumerate(pattern_configs):
+            shm = shared_memory.SharedMemory(
+                create=True, size=frame_buffer_size(self.led_config))
+            self.shms.append(shm)
+            worker_configs[i % self.num_processes][pattern_id] = (cls, params, shm.name)
+            pattern_workers[pattern_id] = (i % self.num_processes, params, shm)
+
+        self.workers = [PatternWorker(self.context, self.led_config, configs)
+                        for configs in worker_configs]
+        await asyncio.gather(*[worker.start() for worker in self.workers])
+        logging.info(f'Started {len(self.workers)} pattern worker processes')
+        # All workers have attached their blocks, so remove the names right away. The
+        # mappings stay valid and the blocks can't leak if the controller is killed.
+        for shm in self.shms:
+            shm.unlink()
+
+        patterns = {}
+        for pattern_id, (worker_index, params, shm) in pattern_workers.items():
+            pattern = RemotePattern(self.workers[worker_index], pattern_id)
+            for key in params:
+                setattr(pattern.params, key, params[key])
+            pattern.prepareSegments(
+                self.led_config, colors=shared_frame_buffer(shm, self.led_config))
+            patterns[pattern_id] = pattern
+        return patterns
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+            worker.process.terminate()
+        for shm in self.shms:
+            try:
+                shm.close()
+            except BufferError:
+                # Frame buffers of the remote patterns still reference the block
+                pass
+        self.workers = []
+        self.shms = []
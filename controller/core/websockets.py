@@ -1,46 +1,381 @@
 import asyncio
-from functools import reduce
 import json
 import numpy as np
-from operator import add
+import struct
+import time
+import urllib.parse
 import websockets
 
+from funky_lights import messages
+from core.frame_ring import FrameReader
+
+
+TEXTURE_FORMAT_RGBA = 'rgba'
+TEXTURE_FORMAT_RGB888 = 'rgb888'
+TEXTURE_FORMAT_RGB565 = 'rgb565'
+TEXTURE_FORMAT_DELTA = 'delta'
+TEXTURE_FORMATS = [TEXTURE_FORMAT_RGBA, TEXTURE_FORMAT_RGB888, TEXTURE_FORMAT_RGB565, TEXTURE_FORMAT_DELTA]
+
+# Header of all formats but rgba: format id, frame type, keyframe id and number of LEDs
+TEXTURE_HEADER = struct.Struct('<BBHI')
+TEXTURE_FORMAT_IDS = {TEXTURE_FORMAT_RGB888: 1, TEXTURE_FORMAT_RGB565: 2, TEXTURE_FORMAT_DELTA: 3}
+TEXTURE_KEYFRAME = 0
+TEXTURE_DELTA_FRAME = 1
+
+# Square textures with power of 2 sides, at least as large as the texture older
+# visualizations expect and at most as large as WebGL implementations commonly support
+MIN_TEXTURE_SIDE = 128
+MAX_TEXTURE_SIDE = 2048
+
+
+def TextureLayout(num_leds, min_side=MIN_TEXTURE_SIDE, max_side=MAX_TEXTURE_SIDE):
+    """ Computes how the LEDs are laid out on textures.
+
+    LEDs fill the pixels of the textures row by row in the order of the LED config. All LEDs
+    go on one texture that is as small as possible, unless they don't fit on a texture of
+    max_side. Then they are split across as many textures of max_side as needed.
+    Returns:
+     a dict with num_leds, texture_width, texture_height and num_textures
+    """
+    side = min_side
+    while side * side < num_leds and side < max_side:
+        side *= 2
+    return {
+        'num_leds': num_leds,
+        'texture_width': side,
+        'texture_height': side,
+        'num_textures': max(1, -(-num_leds // (side * side))),
+    }
+
+
+class TextureEncoder:
+    """ Encodes the colors of frames in one of the texture wire formats.
+
+    rgba is the full RGBA texture without header that older visualizations expect, or all
+    textures after each other if the LEDs don't fit on one. Messages of the other formats
+    start with TEXTURE_HEADER, followed by:
+     rgb888: 3 bytes per LED
+     rgb565: a little-endian uint16 per LED
+     delta: keyframes are like rgb888. Delta frames have the little-endian indices of the
+         LEDs that differ from the keyframe, followed by the 3 byte colors of those LEDs. The
+         number in the header is the number of changed LEDs. Indices are uint16, or uint32
+         with more than 65536 LEDs.
+    Deltas are against the last keyframe rather than the previous frame, so clients that
+    skip frames only need to have the keyframe. A new keyframe is sent once a delta wouldn't
+    be smaller than it.
+    """
+
+    def __init__(self, texture_format, texture_size):
+        """ texture_size is the number of pixels of all textures. """
+        if texture_format not in TEXTURE_FORMATS:
+            raise ValueError(f'Unknown texture format: {texture_format}')
+        self.format = texture_format
+        self.texture_size = texture_size
+        self.lut = messages.RGB565_LUTS[messages.ColorFormat.RGB]
+        self.num_leds = None
+        self.keyframe = None
+        self.keyframe_id = 0
+
+    def _allocate(self, num_leds):
+        self.num_leds = num_leds
+        self.keyframe = None
+        if self.format == TEXTURE_FORMAT_RGBA:
+            self.buffer = np.zeros(self.texture_size * 4, dtype=np.uint8)
+            self.pixels = self.buffer.reshape(-1, 4)[:num_leds, :3]
+            return
+        bytes_per_led = 2 if self.format == TEXTURE_FORMAT_RGB565 else 3
+        self.buffer = np.zeros(TEXTURE_HEADER.size + num_leds * bytes_per_led, dtype=np.uint8)
+        self.buffer[:TEXTURE_HEADER.size] = np.frombuffer(TEXTURE_HEADER.pack(
+            TEXTURE_FORMAT_IDS[self.format], TEXTURE_KEYFRAME, 0, num_leds), dtype=np.uint8)
+        payload = self.buffer[TEXTURE_HEADER.size:]
+        if self.format == TEXTURE_FORMAT_RGB565:
+            self.words = payload.view('<u2')
+            self.tmp = np.zeros(num_leds, dtype='<u2')
+            self.indices = np.zeros(num_leds, dtype=np.intp)
+        else:
+            self.pixels = payload.reshape(-1, 3)
+        if self.format == TEXTURE_FORMAT_DELTA:
+            self.keyframe_colors = np.zeros((num_leds, 3), dtype=np.uint8)
+            self.differs = np.zeros((num_leds, 3), dtype=bool)
+            self.changed = np.zeros(num_leds, dtype=bool)
+            self.index_dtype = '<u2' if num_leds <= 65536 else '<u4'
+
+    def encode(self, colors):
+        """ Encodes a Nx3 array with the colors of all LEDs.
+        Returns:
+         the message as immutable bytes and for delta frames the keyframe message that the
+         client needs to have received before, otherwise None
+        """
+        if len(colors) != self.num_leds:
+            self._allocate(len(colors))
+        if self.format == TEXTURE_FORMAT_RGB565:
+            for channel in range(3):
+                np.copyto(self.indices, colors[:, channel])
+                np.take(self.lut[channel], self.indices, out=self.tmp if channel else self.words, mode='clip')
+                if channel:
+                    np.bitwise_or(self.words, self.tmp, out=self.words)
+            return self.buffer.tobytes(), None
+        if self.format != TEXTURE_FORMAT_DELTA:
+            self.pixels[:] = colors
+            return self.buffer.tobytes(), None
+
+        if self.keyframe is not None:
+            np.not_equal(colors, self.keyframe_colors, out=self.differs)
+            np.any(self.differs, axis=1, out=self.changed)
+            indices = np.flatnonzero(self.changed)
+            # Index and 3 bytes of color per changed LED
+            if len(indices) * (np.dtype(self.index_dtype).itemsize + 3) < self.num_leds * 3:
+                header = TEXTURE_HEADER.pack(
+                    TEXTURE_FORMAT_IDS[self.format], TEXTURE_DELTA_FRAME, self.keyframe_id, len(indices))
+                msg = b''.join([header, indices.astype(self.index_dtype).tobytes(), colors[indices].tobytes()])
+                return msg, self.keyframe
+        self.keyframe_id = (self.keyframe_id + 1) % 65536
+        np.copyto(self.keyframe_colors, colors)
+        self.pixels[:] = colors
+        self.buffer[:TEXTURE_HEADER.size] = np.frombuffer(TEXTURE_HEADER.pack(
+            TEXTURE_FORMAT_IDS[self.format], TEXTURE_KEYFRAME, self.keyframe_id, self.num_leds), dtype=np.uint8)
+        self.keyframe = self.buffer.tobytes()
+        return self.keyframe, self.keyframe
+
+
+class TextureClient:
+    """ One-slot mailbox and sender of a single texture client.
+
+    The publisher only ever replaces the message in the mailbox, so a client that stalls
+    holds on to at most one frame. Frames are sent at most max_fps times per second, and
+    less often while sending takes long, so slow clients get fewer frames instead of
+    growing queues. Before a delta frame, the keyframe it is based on is sent if the client
+    doesn't have it yet.
+    """
+
+    # Weight of the latest send in the smoothed send latency
+    LATENCY_SMOOTHING = 0.2
+    # Minimum time between frames as multiple of the smoothed send latency
+    LATENCY_FACTOR = 2.0
+
+    def __init__(self, websocket, texture_format, max_fps, stats):
+        self.websocket = websocket
+        self.format = texture_format
+        self.max_fps = max_fps
+        self.stats = stats
+        self.msg = None
+        self.keyframe = None
+        # Last keyframe that was sent
+        self.sent_keyframe = None
+        self.bytes_sent = 0
+        self.new_msg = asyncio.Event()
+        # Smoothed time in seconds that sending a frame takes
+        self.send_latency = 0.0
+
+    @property
+    def interval(self):
+        return max(1.0 / self.max_fps, self.LATENCY_FACTOR * self.send_latency)
+
+    def set_format(self, texture_format):
+        if texture_format != self.format:
+            self.format = texture_format
+            self.sent_keyframe = None
+
+    def put(self, msg, keyframe=None):
+        """ Puts msg and the keyframe it is based on into the mailbox.
+        Returns:
+         True if msg replaced a message that wasn't sent yet
+        """
+        replaced = self.msg is not None
+        self.msg = msg
+        self.keyframe = keyframe
+        self.new_msg.set()
+        return replaced
+
+    async def run(self):
+        next_time = 0.0
+        try:
+            while True:
+                await self.new_msg.wait()
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                msg, self.msg = self.msg, None
+                keyframe = self.keyframe
+                self.new_msg.clear()
+                start = time.monotonic()
+                if keyframe is not None and keyframe is not self.sent_keyframe:
+                    await self.websocket.send(keyframe)
+                    self.sent_keyframe = keyframe
+                    self.bytes_sent += len(keyframe)
+                if msg is not keyframe:
+                    await self.websocket.send(msg)
+                    self.bytes_sent += len(msg)
+                latency = time.monotonic() - start
+                self.send_latency += self.LATENCY_SMOOTHING * (latency - self.send_latency)
+                self.stats.add('send_latency/texture', latency * 1000)
+                next_time = start + self.interval
+        except websockets.ConnectionClosed:
+            pass
+
 
 class TextureWebSocketsServer:
+    """ Sends every frame as a texture to the visualization in the browser.
+
+    Every frame is encoded once per texture format in use and the same message is put into
+    the mailbox of every client of that format. Clients pick a format of TEXTURE_FORMATS and
+    limit their frame rate with query parameters, e.g. ws://host:5678/?format=delta&max_fps=10,
+    or by sending {"format": "delta", "max_fps": 10} at any time. Without a format, clients
+    get the full rgba texture.
+
+    The size and number of textures follow from the number of LEDs, see TextureLayout.
+    Clients that pick a format get a JSON message with the texture_layout and their format
+    and max_fps before the first frame, so they can allocate their textures once, and again
+    after every control message.
+    """
+
+    MAX_FPS = 60.0
+
     def __init__(self, pattern_generator):
         self.pattern_generator = pattern_generator
-        self.TEXTURE_WIDTH = 128
-        self.TEXTURE_HEIGHT = 128
-        self.TEXTURE_SIZE = self.TEXTURE_WIDTH * self.TEXTURE_HEIGHT * 4
-
-    async def PrepareTextureMsg(self, segments):
-        out = np.zeros(self.TEXTURE_SIZE, dtype=np.uint8)
-        r = np.concatenate([segment.colors[:, 0] for segment in segments], axis=None)
-        g = np.concatenate([segment.colors[:, 1] for segment in segments], axis=None)
-        b = np.concatenate([segment.colors[:, 2] for segment in segments], axis=None)
-        color_bytes = reduce(add, [segment.num_leds for segment in segments]) * 4
-        out[:color_bytes:4] = r
-        out[1:color_bytes:4] = g
-        out[2:color_bytes:4] = b
-        return bytearray(out)
+        self.layout = TextureLayout(len(pattern_generator.frames.slots[0].colors))
+        self.TEXTURE_WIDTH = self.layout['texture_width']
+        self.TEXTURE_HEIGHT = self.layout['texture_height']
+        # Size of the rgba message of all textures
+        self.TEXTURE_SIZE = self.TEXTURE_WIDTH * self.TEXTURE_HEIGHT * 4 * self.layout['num_textures']
+        # Texture format -> encoder, created when the first client asks for the format
+        self.encoders = {}
+        self.clients = set()
+        self.publisher = None
+        self.frames_skipped = 0
+        self.bytes_sent = 0
+        self.stats = pattern_generator.stats
+        self.stats.add_counter('clients/texture', lambda: len(self.clients))
+        self.stats.add_counter('skipped_frames/texture', lambda: self.frames_skipped)
+        self.stats.add_counter(
+            'bytes_sent/texture', lambda: self.bytes_sent + sum(c.bytes_sent for c in self.clients))
+
+    def PrepareTextureMsg(self, frame, texture_format=TEXTURE_FORMAT_RGBA):
+        """ Encodes frame in texture_format.
+        Returns:
+         immutable bytes that can be shared by all clients and the keyframe that they need
+         for delta frames, or None
+        """
+        if texture_format not in self.encoders:
+            self.encoders[texture_format] = TextureEncoder(texture_format, self.TEXTURE_SIZE // 4)
+        return self.encoders[texture_format].encode(frame.colors)
+
+    async def publish(self):
+        frames = FrameReader(self.pattern_generator.frames)
+        while True:
+            frame = await frames.next()
+            if not self.clients:
+                continue
+            with self.stats.timer('encode/texture'):
+                msgs = {f: self.PrepareTextureMsg(frame, f) for f in {c.format for c in self.clients}}
+            for client in self.clients:
+                self.frames_skipped += client.put(*msgs[client.format])
+
+    def _max_fps(self, value, default):
+        try:
+            return min(max(float(value), 1.0), self.MAX_FPS)
+        except (TypeError, ValueError):
+            return default
+
+    def _format(self, value, default):
+        return value if value in TEXTURE_FORMATS else default
+
+    async def send_layout(self, client):
+        await client.websocket.send(json.dumps({
+            'texture_layout': self.layout,
+            'format': client.format,
+            'max_fps': client.max_fps,
+        }))
+
+    async def serve(self, websocket, path):
+        if self.publisher is None:
+            self.publisher = asyncio.ensure_future(self.publish())
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(path).query)
+        client = TextureClient(
+            websocket, self._format(query.get('format', [None])[0], TEXTURE_FORMAT_RGBA),
+            self._max_fps(query.get('max_fps', [None])[0], self.MAX_FPS), self.stats)
+        handshake = 'format' in query
+        self.clients.add(client)
+        sender = None
+        try:
+            if handshake:
+                await self.send_layout(client)
+            sender = asyncio.ensure_future(client.run())
+            # Control messages from the client
+            async for message in websocket:
+                try:
+                    request = json.loads(message)
+                except ValueError:
+                    continue
+                if not isinstance(request, dict):
+                    continue
+                if 'max_fps' in request:
+                    client.max_fps = self._max_fps(request['max_fps'], client.max_fps)
+                if 'format' in request:
+                    client.set_format(self._format(request['format'], client.format))
+                if handshake:
+                    await self.send_layout(client)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.clients.discard(client)
+            self.bytes_sent += client.bytes_sent
+            if sender:
+                sender.cancel()
+
+
+class StatsWebSocketsServer:
+    def __init__(self, pattern_generator, interval=1.0):
+        self.pattern_generator = pattern_generator
+        self.interval = interval
 
     async def serve(self, websocket, path):
         while True:
-            segments = await asyncio.shield(self.pattern_generator.result)
             try:
-                await websocket.send(await self.PrepareTextureMsg(segments))
+                await websocket.send(json.dumps(self.pattern_generator.stats.to_dict()))
             except websockets.ConnectionClosed as exc:
                 break
+            await asyncio.sleep(self.interval)
+
+
+# Time in seconds between heartbeats of the pattern mix publisher
+PATTERN_MIX_HEARTBEAT_INTERVAL = 2.0
 
 
 class PatternMixWebSocketsServer:
-    def __init__(self, pattern_generator):
+    """ Publishes the pattern mix to follower controllers.
+
+    Subscribers get a snapshot of the pattern mix when they connect:
+     {"type": "snapshot", "sequence": 3, "pattern_mix": {...}}
+    After that, only the keys that changed since the previous message are sent:
+     {"type": "delta", "base": 3, "sequence": 5, "changes": {...}}
+    Without changes, a heartbeat with the current sequence number is sent every
+    heartbeat_interval, so subscribers notice dead connections and missed messages.
+    """
+
+    def __init__(self, pattern_generator, heartbeat_interval=PATTERN_MIX_HEARTBEAT_INTERVAL):
         self.pattern_generator = pattern_generator
+        self.heartbeat_interval = heartbeat_interval
 
     async def serve(self, websocket, path):
+        generator = self.pattern_generator
+        sequence, pattern_mix = generator.pattern_mix_sequence, generator.pattern_mix_snapshot
+        msg = {'type': 'snapshot', 'sequence': sequence, 'pattern_mix': pattern_mix}
         while True:
-            pattern_mix = await asyncio.shield(self.pattern_generator.pattern_mix)
             try:
-                await websocket.send(json.dumps(pattern_mix))
+                await websocket.send(json.dumps(msg))
             except websockets.ConnectionClosed as exc:
                 break
+            # Changes that happened while sending are sent right away, otherwise wait for one
+            if generator.pattern_mix_sequence == sequence:
+                try:
+                    await asyncio.wait_for(asyncio.shield(generator.pattern_mix), self.heartbeat_interval)
+                except asyncio.TimeoutError:
+                    pass
+            if generator.pattern_mix_sequence == sequence:
+                msg = {'type': 'heartbeat', 'sequence': sequence}
+                continue
+            changes = {k: v for k, v in generator.pattern_mix_snapshot.items() if pattern_mix.get(k) != v}
+            msg = {'type': 'delta', 'base': sequence, 'sequence': generator.pattern_mix_sequence,
+                   'changes': changes}
+            sequence, pattern_mix = generator.pattern_mix_sequence, generator.pattern_mix_snapshot
@@ -1,4 +1,5 @@
 import argparse
+import copy
 import json
 import logging
 import time
@@ -11,9 +12,18 @@ import time
 import traceback
 
 from funky_lights import connection, messages
+from core.bus_budget import OVERLOAD_POLICIES, BusBudget
+from core.bus_recovery import RecoveryScheduler
+from core.bus_routing import BusLayout, compile_routing_table
+from core.dmx_udp import connect_to_dmx_udp
+from core.frame_ring import FrameReader, FrameRing
+from core.frame_scheduler import FRAME_POLICIES, FrameScheduler
+from core.frame_stats import FrameStats
+from core.latch_skew import LatchSkew
+from core.output_levels import output_levels, rgb_lut
 from core.pattern_selector import PatternSelector
 from core.opc import connect_to_opc
-from core.websockets import TextureWebSocketsServer, PatternMixWebSocketsServer
+from core.websockets import TextureWebSocketsServer, PatternMixWebSocketsServer, StatsWebSocketsServer
 from patterns import pattern_config
 
 logging.basicConfig(
@@ -24,29 +34,86 @@ logging.basicConfig(
 
 
 class SerialWriter(asyncio.Protocol):
-    def __init__(self, generator, uids, color_format):
+    def __init__(self, generator, name, layout, lut, budget, recovery, keyframe_interval=1.0,
+                 multi_segment_msgs=False, compressed_msgs=False, latch_skew=None):
         super().__init__()
         self.transport = None
         self.generator = generator
-        self.uids = uids
-        self.color_format = color_format
+        self.name = name
+        self.frames = FrameReader(generator.frames)
+        self.layout = layout
+        # Cleared while the transport's write buffer is above its high-water mark
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+        self.budget = budget
+        self.recovery = recovery
+        self.recovery.register(name)
+
+        # Send all segments of a frame in one CMD_LEDS_MULTI message (needs a recent firmware)
+        self.multi_segment_msgs = multi_segment_msgs
+        # The colors of all LEDs on the bus are gathered in wire order and encoded together.
+        # Multi-segment messages only carry raw LED data, so they take precedence over
+        # run-length encoded and palette indexed messages (also need a recent firmware).
+        self.encoder = messages.LedBusEncoder(
+            layout.uids, layout.num_leds, lut, compress=compressed_msgs and not multi_segment_msgs)
+        # With latch_skew, a latch after the LED data of every frame makes all controllers of
+        # the bus show the frame at once (needs a recent firmware)
+        self.latch_skew = latch_skew
+        # Latch with idle time around it, see messages.PrepareLatchSequence. Needs the
+        # baudrate of the transport.
+        self.latch_msg = None
+        if latch_skew:
+            latch_skew.register(name)
+        # Last message sent and the time it was sent per segment, to skip unchanged segments
+        self.keyframe_interval = keyframe_interval
+        self.sent_msgs = {}
+        self.sent_times = {}
+        self.segments_skipped = 0
+        self.stats = generator.stats
+        self.stats.add_counter('missed_frames/serial/%s' % name, lambda: self.frames.frames_missed)
+        self.stats.add_counter('link_utilisation/%s' % name, lambda: self.budget.utilisation)
+        self.stats.add_counter('dropped_frames/serial/%s' % name, lambda: self.budget.frames_dropped)
+        self.stats.add_counter('deferred_segments/serial/%s' % name, lambda: self.budget.segments_deferred)
+        self.stats.add_counter('skipped_segments/serial/%s' % name, lambda: self.segments_skipped)
+        self.stats.add_counter('recoveries/serial/%s' % name, lambda: self.recovery.recoveries[name])
+        self.stats.add_counter('compressed_segments/serial/%s' % name,
+                               lambda: self.encoder.rle_msgs + self.encoder.palette_msgs)
 
     def connection_made(self, transport):
         """Store the serial transport and schedule the task to send data.
         """
         self.transport = transport
+        # Keep at most two frames worth of data buffered, so the LEDs don't lag behind
+        transport.set_write_buffer_limits(high=int(2 * self.budget.bytes_per_frame))
+        self.latch_msg = messages.PrepareLatchSequence(
+            max(self.layout.num_leds, default=0), transport.serial.baudrate)
+        # Idle bytes after the latch
+        self.latch_tail = (len(self.latch_msg) - len(messages.PrepareLatchMsg())) // 2
         print('Writer connection created')
+        # Controllers may have rebooted while the bus was disconnected
+        self.recovery.request(self.name)
         asyncio.ensure_future(self.serve())
         print('Writer.send() scheduled')
 
     def connection_lost(self, exc):
         print('Writer closed')
 
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    async def drain(self):
+        """ Waits until all LED data has left the transport and the serial driver. """
+        while self.transport.get_write_buffer_size() or self.transport.serial.out_waiting:
+            await asyncio.sleep(0.002)
 
     async def initialize_lights(self):
         serial = self.transport.serial
         current_baudrate = serial.baudrate
-        await asyncio.sleep(0.05)
+        # Changing the baudrate would garble LED data that is still queued
+        await self.drain()
         # Start application
         serial.baudrate = connection.BOOTLOADER_BAUDRATE
         serial.write(messages.PrepareStartLedControllerMsg(messages.BROADCAST_UID))
@@ -58,83 +125,148 @@ class SerialWriter(asyncio.Protocol):
         await asyncio.sleep(0.01)
         # Return to normal operations
         serial.baudrate = current_baudrate
-        
+        # Restarted controllers have no LED data yet, so resend all segments
+        self.sent_times.clear()
+
+    def is_dirty(self, index, msg, now):
+        """ Checks whether the segment at index on the bus needs to be sent. A segment is sent
+        if its message differs from the last one sent or if the keyframe interval has passed.
+        """
+        if now - self.sent_times.get(index, -float('inf')) >= self.keyframe_interval:
+            return True
+        if msg != self.sent_msgs[index]:
+            return True
+        self.segments_skipped += 1
+        return False
+
+    def mark_sent(self, index, msg, now):
+        if index not in self.sent_msgs:
+            self.sent_msgs[index] = bytearray(len(msg))
+        self.sent_msgs[index][:] = msg
+        self.sent_times[index] = now
 
     async def serve(self):
-        last_init_time = time.time() - 2.0
         while True:
-            # Initialize lights every second (should only affect lights that are in bootloader mode)
-            if (time.time() - last_init_time) > 1.0:
-                await self.initialize_lights()
-                last_init_time = time.time()
+            # Start lights that are in bootloader mode when the recovery scheduler says so
+            if self.recovery.is_due(self.name, time.monotonic()):
+                with self.stats.timer('recovery/%s' % self.name):
+                    await self.recovery.run(self.name, self.initialize_lights)
 
             # Send color messages
-            segments = await asyncio.shield(self.generator.result)
-            for segment in segments:
-                if segment.uid in self.uids:
-                    self.transport.serial.write(
-                        messages.PrepareLedMsg(segment.uid, segment.colors, self.color_format))
+            await self.can_write.wait()
+            frame = await self.frames.next()
+            now = time.monotonic()
+            with self.stats.timer('encode/%s' % self.name):
+                msgs = self.encoder.encode(self.layout.gather(frame.colors))
+                dirty = [i for i, msg in enumerate(msgs) if self.is_dirty(i, msg, now)]
+            queued_bytes = self.transport.get_write_buffer_size() + self.transport.serial.out_waiting
+            if self.multi_segment_msgs:
+                # A table entry with UID and number of LEDs replaces the header of each message
+                sizes = [len(msgs[i]) - 2 for i in dirty]
+            else:
+                sizes = [len(msgs[i]) for i in dirty]
+            # The latch and its idle time take a fixed share of every frame
+            overhead = len(self.latch_msg) if self.latch_skew else 0
+            selected = self.budget.select(dirty, sizes, queued_bytes=queued_bytes + overhead)
+            if not selected:
+                continue
+            with self.stats.timer('write/%s' % self.name):
+                # One write per bus and frame. The transport keeps a reference to the data
+                # until it is sent, so it gets its own copy of the reused encoder buffer.
+                if self.multi_segment_msgs:
+                    data = [self.encoder.multi_msg(selected)]
+                else:
+                    data = [msgs[i] for i in selected]
+                if self.latch_skew:
+                    data.append(self.latch_msg)
+                data = b''.join(data)
+                self.transport.write(data)
+                for i in selected:
+                    self.mark_sent(i, msgs[i], now)
+            if self.latch_skew:
+                # Everything queued before the latch has to leave the wire first
+                latch_bytes = queued_bytes + len(data) - self.latch_tail
+                latch_time = time.monotonic() + latch_bytes * 10 / self.transport.serial.baudrate
+                self.latch_skew.add(self.name, frame, latch_time)
 
 
 class PatternGenerator:
     def __init__(self, args, pattern_selector):
         self.args = args
         self.pattern_selector = pattern_selector
-        self.result = asyncio.Future()
+        self.frames = FrameRing(pattern_selector.led_config)
+        self.stats = FrameStats()
+        self.pattern_selector.pattern_mix.stats = self.stats
 
         if args.enable_pattern_mix_publisher:
+            # Sequence number and copy of the last published pattern mix, and a future that is
+            # resolved when the pattern mix changes
+            self.pattern_mix_sequence = 0
+            self.pattern_mix_snapshot = copy.deepcopy(self.pattern_selector.get_pattern_mix())
             self.pattern_mix = asyncio.Future()
+            self.stats.add_counter('pattern_mix_changes', lambda: self.pattern_mix_sequence)
 
         self._LOG_RATE = 1.0
 
+    def publish_pattern_mix(self):
+        pattern_mix = self.pattern_selector.get_pattern_mix()
+        if pattern_mix == self.pattern_mix_snapshot:
+            return
+        # The pattern selector changes its lists in place, so publish a copy
+        self.pattern_mix_snapshot = copy.deepcopy(pattern_mix)
+        self.pattern_mix_sequence += 1
+        self.pattern_mix.set_result(self.pattern_mix_sequence)
+        self.pattern_mix = asyncio.Future()
+
     async def tick(self, pattern, delta):
         await pattern.animate(delta)
 
     async def run(self):
         await self.pattern_selector.initializePatterns()
-        animation_time_delta = 1.0 / self.args.animation_rate
-        cur_animation_time = time.time()
-        next_animation_time = cur_animation_time + animation_time_delta
-        prev_log_time = cur_animation_time
-        log_counter = 0
+        scheduler = FrameScheduler(
+            self.args.animation_rate, self.args.frame_policy, self.args.max_catch_up_frames)
+        self.stats.add_counter('frames_rendered', lambda: scheduler.frames_rendered)
+        self.stats.add_counter('frames_late', lambda: scheduler.frames_late)
+        self.stats.add_counter('frames_dropped', lambda: scheduler.frames_dropped)
+        prev_log_time = time.monotonic()
+        prev_frames_rendered = 0
+        prev_frames_late = 0
+        prev_frames_dropped = 0
 
         while True:
-            cur_animation_time = next_animation_time
-            next_animation_time = cur_animation_time + animation_time_delta
+            # Wait for the next frame slot
+            animation_time_delta = await scheduler.wait_for_frame()
 
-            # Skip a frame if falling too far behind
-            if time.time() > next_animation_time:
-                print("Falling behind. Skipping frame.")
-                continue
+            frame_start_time = time.perf_counter()
 
-            # Update pattern selection
-            pattern = self.pattern_selector.update(cur_animation_time)
+            # Update pattern selection in the same time base the patterns are animated in
+            with self.stats.timer('pattern_selector'):
+                pattern = self.pattern_selector.update(scheduler.animation_time)
 
             # Update results future for processing by IO
             if self.args.enable_pattern_mix_publisher:
-                self.pattern_mix.set_result(self.pattern_selector.get_pattern_mix())
-                self.pattern_mix = asyncio.Future()
+                self.publish_pattern_mix()
 
             # Process animation
             await self.tick(pattern, animation_time_delta)
 
-            # Update results future for processing by IO
-            self.result.set_result(pattern.segments)
-            self.result = asyncio.Future()
+            # Publish the frame for processing by IO
+            self.frames.publish(pattern.colors, time.monotonic())
+            self.stats.add('frame', (time.perf_counter() - frame_start_time) * 1000)
 
-            # Output update rate to console
-            log_counter += 1
-            cur_log_time = time.time()
+            # Report update rate and late and dropped frames
+            cur_log_time = time.monotonic()
             log_time_delta = cur_log_time - prev_log_time
             if log_time_delta > 1.0 / self._LOG_RATE:
-                print("Animation FPS: %.1f" % (log_counter / log_time_delta))
-                log_counter = 0
+                logging.info("Animation FPS: %.1f, late frames: %d, dropped frames: %d" % (
+                    (scheduler.frames_rendered - prev_frames_rendered) / log_time_delta,
+                    scheduler.frames_late - prev_frames_late,
+                    scheduler.frames_dropped - prev_frames_dropped))
+                prev_frames_rendered = scheduler.frames_rendered
+                prev_frames_late = scheduler.frames_late
+                prev_frames_dropped = scheduler.frames_dropped
                 prev_log_time = cur_log_time
 
-            # Sleep for the remaining time
-            await asyncio.sleep(max(0, next_animation_time - time.time()))
-
-
 
 async def main():
     # Parse command line arguments
@@ -147,12 +279,39 @@ async def main():
                         help="Enable pattern caching")
     parser.add_argument("-a", "--animation_rate", type=int, default=20, 
                         help="The target animation rate in Hz")
+    parser.add_argument("--frame_policy", choices=FRAME_POLICIES, default="drop", 
+                        help="What to do when falling behind: drop missed frames, stretch the animation delta "
+                             "of the next frame or catch up on a bounded number of missed frames")
+    parser.add_argument("--max_catch_up_frames", type=int, default=2, 
+                        help="The maximum number of frames rendered back to back with the catch_up frame policy")
+    parser.add_argument("--serial_overload_policy", choices=OVERLOAD_POLICIES, default="round_robin", 
+                        help="What to do when a serial bus can't carry all its segments at the animation rate: "
+                             "send everything anyway, refresh segments round-robin or drop to the newest frame")
+    parser.add_argument("--serial_keyframe_interval", type=float, default=1.0, 
+                        help="Segments whose LED data didn't change are only resent after this many seconds. "
+                             "0 sends every segment in every frame.")
+    parser.add_argument("--recovery_interval", type=float, default=10.0, 
+                        help="Restart LED controllers that are stuck in the bootloader every this many seconds. "
+                             "Buses take turns. 0 only restarts them during the reboot window.")
+    parser.add_argument("--recovery_window", type=float, default=10.0, 
+                        help="Restart LED controllers every second for this many seconds after a bus connects")
+    parser.add_argument("--enable_latch", action='store_true', 
+                        help="Send a latch after the LED data of every frame, so all controllers of a bus "
+                             "show the frame at the same time. Reports the remaining skew between buses.")
+    parser.add_argument("--gamma", type=float, default=1.0, 
+                        help="Gamma correction applied to all LED outputs")
+    parser.add_argument("--brightness", type=float, default=1.0, 
+                        help="Master dimmer from 0 to 1 applied to all LED outputs")
+    parser.add_argument("--render_processes", type=int, default=0, 
+                        help="Render patterns in this many worker processes. 0 renders on the event loop.")
     parser.add_argument("--enable_dmx", action='store_true', 
                         help="Enables support for a DMX device")
     parser.add_argument("--dmx_config", type=argparse.FileType('r'), default="../config/dmx_config_enttec.json", 
                         help="DMX config file")
     parser.add_argument("--ws_port_texture", type=int, default=5678, 
                         help="The WebSockets port for the texture server")
+    parser.add_argument("--ws_port_stats", type=int, default=5681, 
+                        help="The WebSockets port for the frame timing stats server")
     parser.add_argument("--enable_launchpad", action='store_true', 
                         help="Enables support for a USB launchpad device")
     parser.add_argument("--ws_port_launchpad", type=int, default=5679, 
@@ -198,6 +357,11 @@ async def main():
     futures.append(websockets.serve(pattern_selector.launchpadWSListener,
                    '0.0.0.0', args.ws_port_launchpad))
 
+    # WS server for the frame timing stats
+    ws_stats = StatsWebSocketsServer(pattern_generator)
+    futures.append(websockets.serve(ws_stats.serve,
+                   '0.0.0.0', args.ws_port_stats))
+
     # Publisher and subscriber for pattern mix
     if args.enable_pattern_mix_publisher:
         ws_pattern_mix_publish = PatternMixWebSocketsServer(pattern_generator) 
@@ -208,7 +372,15 @@ async def main():
 
     # Start serial
     loop = asyncio.get_event_loop()
+    routing_table = compile_routing_table(led_config, bus_config)
+    recovery = RecoveryScheduler(interval=args.recovery_interval, reboot_window=args.recovery_window)
+    latch_skew = LatchSkew(pattern_generator.stats) if args.enable_latch else None
     for bus in bus_config['led_busses']:
+        # Gamma, master dimmer and the color balance of the bus are folded into lookup tables
+        levels = output_levels(args.gamma, args.brightness, bus.get('color_balance', (1.0, 1.0, 1.0)))
+
+        layout = BusLayout(led_config, routing_table[bus['name']])
+
         if "device" in bus:
             # Start the light app
             serial_port = connection.InitializeController(bus['device'], baudrate=bus['baudrate'])
@@ -218,8 +390,15 @@ async def main():
             serial_serve_handler = functools.partial(
                 SerialWriter, 
                 generator=pattern_generator, 
-                uids=bus['uids'], 
-                color_format=messages.ColorFormat[bus['color_format']])
+                name=bus['name'],
+                layout=layout, 
+                lut=messages.Rgb565Lut(messages.ColorFormat[bus['color_format']], levels),
+                budget=BusBudget(bus['baudrate'], args.animation_rate, args.serial_overload_policy),
+                recovery=recovery,
+                keyframe_interval=args.serial_keyframe_interval,
+                multi_segment_msgs=bus.get('multi_segment_msgs', False),
+                compressed_msgs=bus.get('compressed_msgs', False),
+                latch_skew=latch_skew)
             futures.append(serial_asyncio.create_serial_connection(
                 loop, serial_serve_handler, bus['device'], baudrate=bus['baudrate']))
 
@@ -227,9 +406,22 @@ async def main():
             opc = bus["opc"]
             futures.append(connect_to_opc(
                 generator=pattern_generator,
+                name=bus['name'],
                 uids=bus['uids'], 
+                layout=layout, 
+                lut=rgb_lut(levels),
                 server_ip=opc['server_ip'], 
-                server_port=opc['server_port']))
+                server_port=opc['server_port'],
+                protocol=opc.get('protocol', 'tcp'),
+                coalesce_channels=opc.get('coalesce_channels', True)))
+
+        if "dmx_udp" in bus:
+            futures.append(connect_to_dmx_udp(
+                generator=pattern_generator,
+                name=bus['name'],
+                layout=layout,
+                config=bus['dmx_udp'],
+                lut=rgb_lut(levels)))
     
     # Wait forever
     try:
@@ -243,4 +435,5 @@ async def main():
         print(traceback.format_exc())
 
 
-asyncio.run(main())
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -28,4 +28,4 @@ class ColorRollPattern(Pattern):
 
     async def animate(self, delta):
         for segment in self.segments:
-            segment.colors = np.roll(segment.colors, 1, axis=0)
\ No newline at end of file
+            segment.colors[:] = np.roll(segment.colors, 1, axis=0)
\ No newline at end of file
@@ -3,10 +3,15 @@ import sys
 
 
 class Segment:
-    def __init__(self, uid, num_leds, led_positions):
+    def __init__(self, uid, num_leds, led_positions, colors=None, offset=0):
         self.uid = uid
         self.num_leds = num_leds
-        self.colors = np.array([[0, 0, 0] for i in range(num_leds)], dtype=np.ubyte)
+        # Offset of the first LED of this segment in the pattern's frame buffer
+        self.offset = offset
+        if colors is None:
+            colors = np.zeros((num_leds, 3), dtype=np.ubyte)
+        # View into the pattern's frame buffer. Always update in place.
+        self.colors = colors
         self.led_positions = np.array(led_positions)
         self.mask = None
 
@@ -18,14 +23,28 @@ class Pattern:
 
     def __init__(self):
         self.segments = []
+        self.colors = None
         self.params = self.PatternParameters()
 
     def reset(self):
         pass
 
-    def prepareSegments(self, led_config):
+    def prepareSegments(self, led_config, colors=None):
+        """ Create the segments of this pattern from the LED config.
+
+        All segment colors are views into a single (total_num_leds, 3) frame buffer
+        stored in self.colors, so whole-frame operations can be done with one NumPy
+        call. An existing buffer can be passed in through colors.
+        """
+        total_num_leds = sum(s['num_leds'] for s in led_config['led_segments'])
+        if colors is None:
+            colors = np.zeros((total_num_leds, 3), dtype=np.ubyte)
+        self.colors = colors
+        offset = 0
         for s in led_config['led_segments']:
-            segment = Segment(s['uid'], s['num_leds'], s['led_positions'])
+            segment = Segment(s['uid'], s['num_leds'], s['led_positions'],
+                              colors=self.colors[offset:offset + s['num_leds']], offset=offset)
+            offset += s['num_leds']
             for mask in self.params.segment_masks:
                 if mask.segment_uid == segment.uid:
                     segment.mask = mask
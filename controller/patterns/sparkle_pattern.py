@@ -1,6 +1,5 @@
 from patterns.pattern import Pattern
 import numpy as np
-import random
 
 
 class SparklePattern(Pattern):
@@ -12,31 +11,12 @@ class SparklePattern(Pattern):
         self.params.decay_param = 0.95
 
     def initialize(self):
-        self.pattern_segments = []
-        for segment in self.segments:
-            pattern_segment = SparklePatternSegment(segment, self.params)
-            pattern_segment.initialize()
-            self.pattern_segments.append(pattern_segment)
+        self.colors[:] = self.params.background_color
 
     async def animate(self, delta):
-        for pattern_segment in self.pattern_segments:
-            await pattern_segment.animate(delta)
-
-
-class SparklePatternSegment(Pattern):
-    def __init__(self, segment, params):
-        self.segment = segment
-        self.params = params
-
-    def initialize(self):
-        np.copyto(self.segment.colors, np.array(
-            [self.params.background_color for i in range(self.segment.num_leds)]))
-
-    async def animate(self, delta):
-        for i in range(self.segment.num_leds):
-             # Decay all LEDs
-            self.segment.colors[i] = self.params.decay_param * self.segment.colors[i] + \
-                    (1 - self.params.decay_param) * self.params.background_color
-            # Sparkle random lights
-            if random.random() <= self.params.sparkle_probability:
-                self.segment.colors[i] = self.params.color
\ No newline at end of file
+        # Decay all LEDs
+        self.colors[:] = self.params.decay_param * self.colors + \
+                (1 - self.params.decay_param) * self.params.background_color
+        # Sparkle random lights
+        sparkles = np.random.random(len(self.colors)) <= self.params.sparkle_probability
+        self.colors[sparkles] = self.params.color
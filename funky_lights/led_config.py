@@ -16,24 +16,57 @@ class LedConfig():
         }
 
 
+def PhysicalOrder(num_leds, reverse=False, offset=0, num_dead_leds=0):
+    """ Maps the LEDs of a strip, in the order they are wired, to the LEDs of a segment.
+    Args:
+     num_leds: number of LEDs in the segment
+     reverse: the strip is wired from the last LED of the segment to the first
+     offset: the strip starts offset LEDs into the segment and wraps around, taken modulo
+      num_leds so negative offsets count back from the end of the segment
+     num_dead_leds: LEDs at the start of the strip that are not part of the segment
+    Returns:
+     an int array with the index of the segment LED for every LED on the strip, -1 for
+     LEDs that are always off
+    """
+    order = np.arange(num_leds)
+    if reverse:
+        order = np.flip(order)
+    if num_leds > 0:
+        order = np.roll(order, -(offset % num_leds))
+    return np.concatenate((np.full(num_dead_leds, -1), order)).astype(int)
+
+
 class Segment():
-    def __init__(self, uid, name, points, num_leds, length):
+    def __init__(self, uid, name, points, num_leds, length, physical_order=None):
         self.uid = uid
         self.name = name
         self.points = points
         self.num_leds = num_leds
         self.length = length
+        self.physical_order = physical_order
 
     def merge(self, other):
+        if self.physical_order is not None or other.physical_order is not None:
+            order = self.physical_order
+            if order is None:
+                order = PhysicalOrder(self.num_leds)
+            other_order = other.physical_order
+            if other_order is None:
+                other_order = PhysicalOrder(other.num_leds)
+            other_order = np.where(other_order >= 0, other_order + self.num_leds, -1)
+            self.physical_order = np.concatenate((order, other_order))
         self.points = np.concatenate((self.points, other.points), axis=0)
         self.num_leds += other.num_leds
         self.length += other.length
 
     def to_dict(self):
-        return {
+        d = {
             'uid': self.uid,
             'name': self.name,
             'num_leds': self.num_leds,
             'length': self.length,
             'led_positions': self.points.tolist()
         }
+        if self.physical_order is not None:
+            d['physical_order'] = self.physical_order.tolist()
+        return d
@@ -1,6 +1,7 @@
-import crc8
 from . import crc16
 from enum import Enum
+import math
+import numpy as np
 
 
 MAGIC = 0x55
@@ -10,6 +11,10 @@ BROADCAST_UID = 0
 CMD_LEDS = 1
 CMD_SERIAL_BAUDRATE = 2
 CMD_BOOTLOADER = 3
+CMD_LEDS_MULTI = 4
+CMD_LEDS_RLE = 5
+CMD_LEDS_PALETTE = 6
+CMD_LATCH = 7
 
 class ColorFormat(Enum):
     GRB = 0
@@ -19,57 +24,299 @@ class ColorFormat(Enum):
     RBG = 4
 
 
+# Indices of the red, green and blue channel in the input colors for each color format
+COLOR_FORMAT_CHANNELS = {
+    ColorFormat.RGB: [0, 1, 2],
+    ColorFormat.BGR: [2, 1, 0],
+    ColorFormat.GRB: [1, 0, 2],
+    ColorFormat.GBR: [2, 0, 1],
+    ColorFormat.RBG: [0, 2, 1],
+}
+
+CRC8_POLYNOMIAL = 0x07
+
+# Maximum payload of any message: 255 LEDs with 2 bytes each
+MAX_PAYLOAD_SIZE = 255 * 2
+
+
+def _Crc8Table(polynomial):
+    table = np.zeros(256, dtype=np.uint8)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ polynomial) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table[i] = crc
+    return table
+
+
+# CRC8 of every single byte value
+CRC8_TABLE = _Crc8Table(CRC8_POLYNOMIAL)
+
+# The CRC8 used here (no reflection, initial value and final XOR of 0) is linear. The CRC
+# of a message is therefore the XOR of the CRCs of each of its bytes followed by as many
+# zero bytes as come after it in the message. Row d holds the CRC of each byte value
+# followed by d zero bytes, which makes the CRC of a whole payload a single gather.
+CRC8_POSITION_TABLE = np.zeros((MAX_PAYLOAD_SIZE, 256), dtype=np.uint8)
+CRC8_POSITION_TABLE[0] = CRC8_TABLE
+for _d in range(1, MAX_PAYLOAD_SIZE):
+    CRC8_POSITION_TABLE[_d] = CRC8_TABLE[CRC8_POSITION_TABLE[_d - 1]]
+
+
+def Crc8(data):
+    """ Compute the CRC8 of data as the LED boards do.
+    Args:
+     data: bytes-like object or uint8 numpy array
+    Returns:
+     the CRC8 as int
+    """
+    data = np.frombuffer(bytes(data), dtype=np.uint8) if not isinstance(data, np.ndarray) else data
+    crc = 0
+    # Longer data is processed in chunks. Feeding a chunk of n bytes into a CRC register
+    # holding crc is the same as XORing the chunk's CRC with that of crc and n - 1 zeros.
+    for start in range(0, len(data), MAX_PAYLOAD_SIZE):
+        chunk = data[start:start + MAX_PAYLOAD_SIZE]
+        positions = np.arange(len(chunk) - 1, -1, -1)
+        crc = int(CRC8_POSITION_TABLE[len(chunk) - 1, crc]) if crc else 0
+        crc ^= int(np.bitwise_xor.reduce(CRC8_POSITION_TABLE[positions, chunk], initial=0))
+    return crc
+
+
+def Rgb565Lut(color_format=ColorFormat.GRB, levels=None):
+    """ Lookup tables that convert RGB colors to the RGB565 words sent to the LEDs.
+    Args:
+     color_format: order of the color channels on the LEDs
+     levels: optional 3x256 array with the output level (0-255) of every input value of the
+         red, green and blue channel, e.g. with gamma correction and dimming applied
+    Returns:
+     a 3x256 little-endian uint16 array. The word of a color is lut[0][r] | lut[1][g] | lut[2][b].
+    """
+    if levels is None:
+        levels = np.tile(np.arange(256), (3, 1))
+    levels = np.rint(np.clip(levels, 0, 255)).astype(np.uint16)
+    # Bit shifts and widths of the red, green and blue slot of a RGB565 word
+    slots = [(11, 3), (5, 2), (0, 3)]
+    channels = COLOR_FORMAT_CHANNELS[color_format]
+    lut = np.zeros((3, 256), dtype='<u2')
+    for slot, channel in enumerate(channels):
+        shift, truncate = slots[slot]
+        lut[channel] = (levels[channel] >> truncate) << shift
+    return lut
+
+
+# Lookup tables without gamma correction for each color format
+RGB565_LUTS = {color_format: Rgb565Lut(color_format) for color_format in ColorFormat}
+
+# A run of a run-length encoded LED message: number of LEDs and their RGB565 color
+RLE_RUN_DTYPE = np.dtype([('count', 'u1'), ('color', '<u2')])
+
+
+class LedBusEncoder:
+    """ Encodes the LED messages of all segments on a bus into one preallocated buffer.
+
+    The headers are written once. Every call to encode converts the colors of the whole bus
+    with one lookup per channel, computes the CRC8s of all messages together and writes the
+    results into the buffer. The returned memoryviews are only valid until the next call.
+
+    With compress, segments whose colors compress well are sent as run-length encoded or
+    palette indexed message instead, whichever of the three encodings is the smallest.
+    """
+
+    def __init__(self, uids, num_leds, lut, compress=False):
+        self.lut = lut
+        self.uids = list(uids)
+        self.num_leds = np.array(num_leds, dtype=np.intp)
+        sizes = [LedMsgSize(n) for n in num_leds]
+        starts = np.cumsum([0] + sizes[:-1]).astype(np.intp)
+        self.buffer = np.zeros(sum(sizes), dtype=np.uint8)
+        buffer = memoryview(self.buffer)
+        self.msgs = []
+        payload_positions = []
+        crc_offsets = []
+        for uid, n, start, size in zip(uids, num_leds, starts, sizes):
+            self.buffer[start:start + 4] = [MAGIC, uid, CMD_LEDS, n]
+            self.msgs.append(buffer[start:start + size])
+            payload_positions.append(np.arange(start + 4, start + 4 + n * 2))
+            crc_offsets.append(np.arange(n * 2 - 1, -1, -1) * 256)
+        self.payload_positions = np.concatenate(payload_positions + [[]]).astype(np.intp)
+        self.crc_offsets = np.concatenate(crc_offsets + [[]]).astype(np.intp)
+        self.crc_positions = starts + np.array(sizes, dtype=np.intp) - 1
+        # Start of the payload of each message in the payload of the bus. Messages without
+        # LEDs have a CRC of 0.
+        self.crc_starts = np.cumsum([0] + [n * 2 for n in num_leds[:-1]]).astype(np.intp)
+        self.empty = np.array(num_leds) == 0
+
+        # Scratch arrays
+        total_num_leds = sum(num_leds)
+        self.words = np.zeros(total_num_leds, dtype='<u2')
+        self.payload = self.words.view(np.uint8)
+        self.tmp = np.zeros(total_num_leds, dtype='<u2')
+        self.indices = np.zeros(total_num_leds, dtype=np.intp)
+        self.crc_indices = np.zeros(total_num_leds * 2, dtype=np.intp)
+        # One extra zero, so that messages without LEDs at the end of the bus have a valid start
+        self.crc_values = np.zeros(total_num_leds * 2 + 1, dtype=np.uint8)
+        self.crcs = np.zeros(len(num_leds), dtype=np.uint8)
+
+        # Compression
+        self.compress = compress
+        self.raw_msgs = self.msgs
+        self.led_starts = np.cumsum([0] + list(num_leds[:-1])).astype(np.intp)
+        self.raw_sizes = np.array(sizes, dtype=np.intp)
+        # Marks the first LED of every run of equal colors. One extra element, so that
+        # segments without LEDs at the end of the bus have a valid start.
+        self.run_starts = np.zeros(total_num_leds + 1, dtype=bool)
+        self.rle_msgs = 0
+        self.palette_msgs = 0
+
+    def encode(self, rgbs):
+        """ Encode a Nx3 array of RGB colors of all LEDs on the bus, in bus order.
+        Returns:
+         a list with a memoryview of the message of every segment
+        """
+        rgbs = np.asarray(rgbs, dtype=np.uint8)
+        for channel in range(3):
+            np.copyto(self.indices, rgbs[:, channel])
+            np.take(self.lut[channel], self.indices, out=self.tmp if channel else self.words, mode='clip')
+            if channel:
+                np.bitwise_or(self.words, self.tmp, out=self.words)
+        np.copyto(self.crc_indices, self.payload)
+        np.add(self.crc_indices, self.crc_offsets, out=self.crc_indices)
+        np.take(CRC8_POSITION_TABLE, self.crc_indices, out=self.crc_values[:-1], mode='clip')
+        np.bitwise_xor.reduceat(self.crc_values, self.crc_starts, out=self.crcs)
+        self.crcs[self.empty] = 0
+        self.buffer[self.payload_positions] = self.payload
+        self.buffer[self.crc_positions] = self.crcs
+        if self.compress:
+            return self._compress()
+        return self.msgs
+
+    def _compress(self):
+        """ Replaces the message of every segment by the smallest of the raw, run-length
+        encoded and palette indexed message.
+        """
+        np.not_equal(self.words[1:], self.words[:-1], out=self.run_starts[1:-1])
+        self.run_starts[self.led_starts] = True
+        self.run_starts[-1] = False
+        num_runs = np.add.reduceat(self.run_starts, self.led_starts, dtype=np.intp)
+        num_runs[self.num_leds == 0] = 0
+        # Header with number of runs, 3 bytes per run and CRC
+        rle_sizes = 5 + 3 * num_runs + 1
+        # Header with number of colors, at least one color, one index per LED and CRC
+        min_palette_sizes = 5 + 2 + self.num_leds + 1
+        best_sizes = np.minimum(self.raw_sizes, rle_sizes)
+        candidates = np.flatnonzero(
+            (rle_sizes < self.raw_sizes) | ((self.num_leds > 0) & (min_palette_sizes < best_sizes)))
+        if not len(candidates):
+            return self.msgs
+
+        # Runs never cross segments, so the runs of the whole bus are found at once
+        run_indices = np.flatnonzero(self.run_starts)
+        runs = np.zeros(len(run_indices), dtype=RLE_RUN_DTYPE)
+        runs['count'] = np.diff(run_indices, append=len(self.words))
+        runs['color'] = self.words[run_indices]
+        run_offsets = np.cumsum(num_runs) - num_runs
+
+        msgs = list(self.raw_msgs)
+        for i in candidates:
+            palette_size = best_sizes[i]
+            if min_palette_sizes[i] < best_sizes[i]:
+                start = self.led_starts[i]
+                palette, palette_indices = np.unique(
+                    self.words[start:start + self.num_leds[i]], return_inverse=True)
+                palette_size = 5 + 2 * len(palette) + self.num_leds[i] + 1
+            if palette_size < best_sizes[i]:
+                payload = palette.tobytes() + palette_indices.astype(np.uint8).tobytes()
+                msgs[i] = self._msg(CMD_LEDS_PALETTE, i, len(palette), payload)
+                self.palette_msgs += 1
+            elif rle_sizes[i] < self.raw_sizes[i]:
+                payload = runs[run_offsets[i]:run_offsets[i] + num_runs[i]].tobytes()
+                msgs[i] = self._msg(CMD_LEDS_RLE, i, num_runs[i], payload)
+                self.rle_msgs += 1
+        return msgs
+
+    def _msg(self, cmd, index, num_items, payload):
+        header = bytes([MAGIC, self.uids[index], cmd, self.num_leds[index], num_items])
+        return b''.join([header, payload, bytes([Crc8(payload)])])
+
+    def multi_msg(self, indices):
+        """ Pack the last encoded messages of the segments at indices into one
+        CMD_LEDS_MULTI message.
+        Returns:
+         bytes, ready to send on the serial port
+        """
+        if len(indices) > 255:
+            raise ValueError('A multi-segment message can hold at most 255 segments')
+        header = bytearray([MAGIC, BROADCAST_UID, CMD_LEDS_MULTI, len(indices)])
+        for i in indices:
+            header.append(self.raw_msgs[i][1])
+            header.append(self.raw_msgs[i][3])
+        header.append(Crc8(header[3:]))
+        # The LED data and CRC of a segment are the same as in its own raw message
+        return b''.join([header] + [self.raw_msgs[i][4:] for i in indices])
+
+
+class LedMsgEncoder(LedBusEncoder):
+    """ Encodes LED messages for a single segment into a preallocated buffer. """
+
+    def __init__(self, bar_uid, num_leds, color_format=ColorFormat.GRB, lut=None):
+        if lut is None:
+            lut = RGB565_LUTS[color_format]
+        super().__init__([bar_uid], [num_leds], lut)
+
+    def encode(self, rgbs):
+        """ Encode a Nx3 array of RGB colors.
+        Returns:
+         a memoryview of the message, ready to send on the serial port
+        """
+        return super().encode(rgbs)[0]
+
+
 def RgbToBits(rgbs, color_format=ColorFormat.GRB):
-    """ Convert RGB value given as a Nx3 numpy array to a list of two bytes that
+    """ Convert RGB value given as a Nx3 numpy array to two bytes per LED that
          can be sent to the LEDs.
     Args:
-     rgbs: list of rgb tuples
+     rgbs: Nx3 array of rgb colors
+    Returns:
+     a uint8 numpy array with 2 bytes per LED
+    """
+    rgb = np.asarray(rgbs, dtype=np.uint8)
+    lut = RGB565_LUTS[color_format]
+    return (lut[0][rgb[:, 0]] | lut[1][rgb[:, 1]] | lut[2][rgb[:, 2]]).view(np.uint8)
+
+
+def LedMsgSize(num_leds):
+    """ Number of bytes of a LED message for num_leds LEDs: header, 2 bytes per LED and CRC. """
+    return 4 + num_leds * 2 + 1
+
+
+def LedMultiMsgSize(num_leds):
+    """ Number of bytes of a multi-segment LED message: header, a table entry per segment,
+    table CRC and 2 bytes per LED plus a CRC per segment.
+    """
+    return 4 + len(num_leds) * 2 + 1 + sum(n * 2 + 1 for n in num_leds)
+
+
+def PrepareLedMultiMsg(bar_uids, rgbs, color_format=ColorFormat.GRB):
+    """ Prepare one message that sets the LEDs of several bars
+    Args:
+     bar_uids: UIDs of the bars to which we want to send the message
+     rgbs: a Nx3 array of rgb colors per bar
     Returns:
-     a list of bytes
+     a bytearray, ready to send on the serial port
     """
-    out = [0] * (len(rgbs) * 2)
-    if color_format == ColorFormat.RGB:
-        r = rgbs[:, 0]
-        g = rgbs[:, 1]
-        b = rgbs[:, 2]
-    elif color_format == ColorFormat.BGR:
-        b = rgbs[:, 0]
-        g = rgbs[:, 1]
-        r = rgbs[:, 2]
-    elif color_format == ColorFormat.GRB:
-        g = rgbs[:, 0]
-        r = rgbs[:, 1]
-        b = rgbs[:, 2]
-    elif color_format == ColorFormat.GBR:
-        g = rgbs[:, 0]
-        b = rgbs[:, 1]
-        r = rgbs[:, 2]
-    elif color_format == ColorFormat.RBG:
-        r = rgbs[:, 0]
-        b = rgbs[:, 1]
-        g = rgbs[:, 2]
-    out[::2] = ((g << 3) & 0xE0) | ((b >> 3) & 0x1F)
-    out[1::2] = (r & 0xF8) | ((g >> 5) & 0x07)
-    return out
+    encoder = LedBusEncoder(bar_uids, [len(c) for c in rgbs], RGB565_LUTS[color_format])
+    encoder.encode(np.concatenate([np.asarray(c, dtype=np.uint8).reshape(-1, 3) for c in rgbs]))
+    return bytearray(encoder.multi_msg(range(len(bar_uids))))
 
 
 def PrepareLedMsg(bar_uid, rgbs, color_format=ColorFormat.GRB):
     """ Prepare a message from a list of RGB colors
     Args:
-     serial: Serial port object. Should be already initialized
      bar_uid: UID of the bar to which we want to send the message
-     rgbs: list of rgb tuples
+     rgbs: Nx3 array of rgb colors
     Returns:
      a bytearray, ready to send on the serial port
     """
-    header = [MAGIC, bar_uid, CMD_LEDS]
-    header += [len(rgbs)]
-    data = RgbToBits(rgbs, color_format)
-    crc_compute = crc8.crc8()
-    crc_compute.update(bytearray(data))
-    crc = [crc_compute.digest()[0]]
-    msg = header + data + crc
-    return bytearray(msg)
+    return bytearray(LedMsgEncoder(bar_uid, len(rgbs), color_format).encode(rgbs))
 
 
 def PrepareBaudrateMsg(bar_uid, prescaler):
@@ -83,9 +330,7 @@ def PrepareBaudrateMsg(bar_uid, prescaler):
     """
     header = [MAGIC, bar_uid, CMD_SERIAL_BAUDRATE]
     data = [prescaler]
-    crc_compute = crc8.crc8()
-    crc_compute.update(bytearray(data))
-    crc = [crc_compute.digest()[0]]
+    crc = [Crc8(bytearray(data))]
     msg = header + data + crc
     return bytearray(msg)
 
@@ -99,13 +344,54 @@ def PrepareBootloaderMsg(bar_uid):
     """
     header = [MAGIC, bar_uid, CMD_BOOTLOADER]
     data = []
-    crc_compute = crc8.crc8()
-    crc_compute.update(bytearray(header + data))
-    crc = [crc_compute.digest()[0]]
+    crc = [Crc8(bytearray(header + data))]
     msg = header + data + crc
     return bytearray(msg)
 
 
+def PrepareLatchMsg(bar_uid=BROADCAST_UID):
+    """ Prepare a message that shows the LED data received since the previous latch.
+    Args:
+     bar_uid: UID of the bar to which we want to send the message, usually all bars
+    Returns:
+     a bytearray, ready to send on the serial port
+    """
+    header = [MAGIC, bar_uid, CMD_LATCH]
+    crc = [Crc8(bytearray(header))]
+    return bytearray(header + crc)
+
+
+# Time it takes a controller to push the colors of a LED to the strip (24 bits at 800 kHz)
+# and the reset time after the last LED. The controller doesn't receive while it does.
+LED_SHOW_TIME_PER_LED = 30e-6
+LED_SHOW_TIME_RESET = 100e-6
+# Filler byte for idle time on the bus. Controllers ignore it while waiting for MAGIC and,
+# with only the start bit low, it lets their receiver resynchronize on the next byte.
+IDLE_BYTE = 0xFF
+
+
+def LedShowTime(num_leds):
+    """ Time in seconds that a controller is busy showing num_leds LEDs. """
+    return num_leds * LED_SHOW_TIME_PER_LED + LED_SHOW_TIME_RESET
+
+
+def PrepareLatchSequence(max_num_leds, baudrate, bar_uid=BROADCAST_UID):
+    """ Prepare a latch surrounded by enough idle time that every controller receives it.
+
+    Before the first latch, the controller of the last segment before the latch shows its LED
+    data right after it arrives. After the latch, all controllers show their LED data. Both
+    take up to LedShowTime(max_num_leds), during which received bytes are lost.
+    Args:
+     max_num_leds: largest number of LEDs of a controller on the bus
+     baudrate: baudrate of the bus
+    Returns:
+     a bytearray with the idle bytes, the latch message and the idle bytes
+    """
+    # 10 bits per byte with start and stop bits
+    gap = bytearray([IDLE_BYTE]) * math.ceil(LedShowTime(max_num_leds) * baudrate / 10)
+    return gap + PrepareLatchMsg(bar_uid) + gap
+
+
 def PrepareStartLedControllerMsg(bar_uid):
     """ Prepare a message to tell the bootloader to start the LED controller.
     Args:
@@ -0,0 +1,355 @@
+import argparse
+import collections
+import os
+import pty
+import select
+import time
+import tty
+
+from . import connection, messages
+
+
+class VirtualBusDecoder:
+    """ Decodes the serial LED protocol with the same state machine as attiny/attiny.ino.
+
+    Unlike a single ATtiny, the decoder accepts messages for every UID, so it stands in for
+    all controllers on a bus and keeps statistics per UID.
+
+    The timing of the bus is modeled coarsely: every byte takes 10 bits at the baudrate, and
+    while a controller shows its LEDs (messages.LedShowTime) it receives nothing, so it
+    misses messages for itself and latches that start in that time. Bytes that are fed
+    together are assumed to follow each other without gaps, the worst case. Lost bytes don't
+    garble the messages of other controllers here, unlike on the controllers, so the
+    decoder can only count what a controller would have missed.
+    """
+    # Deserializer states
+    IDLE = 0
+    UID = 1
+    CMD = 2
+    NUM_LEDS = 3
+    DATA_LEDS = 4
+    PRESCALER = 5
+    CRC = 6
+    NUM_SEGMENTS = 7
+    TABLE = 8
+    TABLE_CRC = 9
+    MULTI_DATA_LEDS = 10
+    NUM_ITEMS = 11
+
+    MAX_NUM_LEDS = 230
+
+    def __init__(self, baudrate=connection.LED_BAUDRATE):
+        self.state = self.IDLE
+        self.uid = None
+        self.cmd = None
+        self.num_leds = 0
+        self.data = bytearray()
+        self.table = bytearray()
+        self.multi_size = 0
+        self.num_items = 0
+        self.payload_size = 0
+
+        # Time on the wire of the current byte and of the MAGIC of the current message
+        self.byte_time = 10 / baudrate
+        self.time = 0.0
+        self.msg_time = 0.0
+        # Time until which the controller of a UID shows its LEDs and doesn't receive
+        self.busy_until = {}
+
+        # Last LED payload (RGB565, 2 bytes per LED) received per UID
+        self.leds = {}
+        # Last LED payload shown per UID. Once a controller received a latch, it only shows
+        # LED data on the next latch.
+        self.shown_leds = {}
+        # UIDs that received a latch and UIDs with LED data waiting for the next latch
+        self.latch_enabled = set()
+        self.latch_pending = set()
+
+        # Statistics
+        self.frames_received = collections.Counter()
+        self.crc_failures = collections.Counter()
+        # Messages and latches that started while the controller was showing its LEDs
+        self.missed_msgs = collections.Counter()
+        self.missed_latches = collections.Counter()
+        self.baudrate_msgs = 0
+        self.multi_msgs = 0
+        self.rle_msgs = 0
+        self.palette_msgs = 0
+        self.latch_msgs = 0
+        self.bootloader_msgs = 0
+        self.bad_commands = 0
+        self.noise_bytes = 0
+        self.bytes_received = 0
+
+    def feed(self, data, now=None):
+        """ Decodes data. now is the time at which data was read, if it is known. """
+        if now is not None:
+            # The bytes left the wire right before they were read
+            self.time = max(self.time, now - len(data) * self.byte_time)
+        for c in data:
+            self.feed_byte(c)
+        self.bytes_received += len(data)
+
+    def feed_byte(self, c):
+        self.time += self.byte_time
+        if self.state == self.IDLE:
+            if c == messages.MAGIC:
+                self.msg_time = self.time
+                self.state = self.UID
+            else:
+                self.noise_bytes += 1
+        elif self.state == self.UID:
+            self.uid = c
+            self.state = self.CMD
+        elif self.state == self.CMD:
+            self.cmd = c
+            self.data = bytearray()
+            if c in (messages.CMD_LEDS, messages.CMD_LEDS_RLE, messages.CMD_LEDS_PALETTE):
+                self.state = self.NUM_LEDS
+            elif c == messages.CMD_SERIAL_BAUDRATE:
+                self.state = self.PRESCALER
+            elif c == messages.CMD_BOOTLOADER:
+                self.bootloader_msgs += 1
+                self.state = self.IDLE
+            elif c == messages.CMD_LEDS_MULTI:
+                self.state = self.NUM_SEGMENTS
+            elif c == messages.CMD_LATCH:
+                self.data = bytearray([messages.MAGIC, self.uid, c])
+                self.state = self.CRC
+            else:
+                self.bad_commands += 1
+                self.state = self.IDLE
+        elif self.state == self.NUM_LEDS:
+            self.num_leds = c
+            if self.num_leds > self.MAX_NUM_LEDS:
+                # Ignore commands that have too many LEDs
+                self.state = self.IDLE
+            elif self.cmd == messages.CMD_LEDS:
+                self.payload_size = self.num_leds * 2
+                self.state = self.DATA_LEDS if self.payload_size else self.CRC
+            else:
+                self.state = self.NUM_ITEMS
+        elif self.state == self.NUM_ITEMS:
+            # Number of runs or palette colors
+            self.num_items = c
+            if self.cmd == messages.CMD_LEDS_RLE:
+                self.payload_size = self.num_items * 3
+            else:
+                self.payload_size = self.num_items * 2 + self.num_leds
+            if self.payload_size > self.MAX_NUM_LEDS * 2:
+                # Ignore payloads that don't fit into the LED buffer
+                self.state = self.IDLE
+            else:
+                self.state = self.DATA_LEDS if self.payload_size else self.CRC
+        elif self.state == self.DATA_LEDS:
+            self.data.append(c)
+            if len(self.data) == self.payload_size:
+                self.state = self.CRC
+        elif self.state == self.PRESCALER:
+            self.data.append(c)
+            self.state = self.CRC
+        elif self.state == self.NUM_SEGMENTS:
+            self.table = bytearray([c])
+            self.state = self.TABLE if c else self.IDLE
+        elif self.state == self.TABLE:
+            self.table.append(c)
+            if len(self.table) == 1 + self.table[0] * 2:
+                self.state = self.TABLE_CRC
+        elif self.state == self.TABLE_CRC:
+            if c != messages.Crc8(self.table):
+                self.crc_failures[self.uid] += 1
+                self.state = self.IDLE
+            else:
+                self.multi_size = sum(n * 2 + 1 for n in self.table[2::2])
+                self.state = self.MULTI_DATA_LEDS
+        elif self.state == self.MULTI_DATA_LEDS:
+            self.data.append(c)
+            if len(self.data) == self.multi_size:
+                self.state = self.IDLE
+                self.multi_msgs += 1
+                self.decode_multi()
+        elif self.state == self.CRC:
+            self.state = self.IDLE
+            if c != messages.Crc8(self.data):
+                self.crc_failures[self.uid] += 1
+            elif self.cmd in (messages.CMD_LEDS, messages.CMD_LEDS_RLE, messages.CMD_LEDS_PALETTE) and self.busy(self.uid):
+                self.missed_msgs[self.uid] += 1
+            elif self.cmd == messages.CMD_LEDS:
+                self.frames_received[self.uid] += 1
+                self.set_leds(self.uid, bytes(self.data))
+            elif self.cmd == messages.CMD_LEDS_RLE:
+                self.decode_rle()
+            elif self.cmd == messages.CMD_LEDS_PALETTE:
+                self.decode_palette()
+            elif self.cmd == messages.CMD_SERIAL_BAUDRATE:
+                self.baudrate_msgs += 1
+            elif self.cmd == messages.CMD_LATCH:
+                self.latch()
+
+    def busy(self, uid):
+        """ Whether the controller of uid was showing its LEDs when the current message started. """
+        return self.busy_until.get(uid, 0.0) > self.msg_time
+
+    def show_leds(self, uid):
+        self.shown_leds[uid] = self.leds[uid]
+        self.busy_until[uid] = self.time + messages.LedShowTime(len(self.leds[uid]) // 2)
+
+    def set_leds(self, uid, data):
+        self.leds[uid] = data
+        if uid in self.latch_pending:
+            # The previous data was never latched, back to showing LED data right away
+            self.latch_pending.discard(uid)
+            self.latch_enabled.discard(uid)
+        if uid in self.latch_enabled:
+            self.latch_pending.add(uid)
+        else:
+            self.show_leds(uid)
+
+    def latch(self):
+        """ Shows the pending LED data of all controllers that receive the latch at once. """
+        self.latch_msgs += 1
+        uids = list(self.leds) if self.uid == messages.BROADCAST_UID else [self.uid]
+        for uid in uids:
+            if self.busy(uid):
+                self.missed_latches[uid] += 1
+                continue
+            self.latch_enabled.add(uid)
+            if uid in self.latch_pending:
+                self.latch_pending.discard(uid)
+                self.show_leds(uid)
+
+    def decode_rle(self):
+        """ Expands the runs of (count, RGB565 color) of a run-length encoded message. """
+        runs = [(self.data[i], self.data[i + 1:i + 3]) for i in range(0, len(self.data), 3)]
+        if sum(count for count, _ in runs) != self.num_leds:
+            # Like the controllers, ignore messages whose runs don't add up
+            self.bad_commands += 1
+            return
+        self.rle_msgs += 1
+        self.frames_received[self.uid] += 1
+        self.set_leds(self.uid, b''.join(color * count for count, color in runs))
+
+    def decode_palette(self):
+        """ Looks up the RGB565 color of every LED of a palette indexed message. """
+        palette_size = self.num_items * 2
+        palette = [self.data[i:i + 2] for i in range(0, palette_size, 2)]
+        indices = self.data[palette_size:]
+        if any(index >= self.num_items for index in indices):
+            self.bad_commands += 1
+            return
+        self.palette_msgs += 1
+        self.frames_received[self.uid] += 1
+        self.set_leds(self.uid, b''.join(palette[index] for index in indices))
+
+    def decode_multi(self):
+        """ Checks the slice of every segment in a multi-segment message, like each of the
+        controllers on the bus would.
+        """
+        start = 0
+        for uid, num_leds in zip(self.table[1::2], self.table[2::2]):
+            end = start + num_leds * 2
+            data, crc = self.data[start:end], self.data[end]
+            start = end + 1
+            if num_leds > self.MAX_NUM_LEDS:
+                continue
+            if crc != messages.Crc8(data):
+                self.crc_failures[uid] += 1
+            elif self.busy(uid):
+                self.missed_msgs[uid] += 1
+            else:
+                self.frames_received[uid] += 1
+                self.set_leds(uid, bytes(data))
+
+
+class VirtualBus:
+    """ Pseudo-terminal backed stand-in for a serial LED bus.
+
+    Point the device of a bus in bus_config.json at self.device (or at the symlink passed
+    as link) to send LED data to the virtual bus instead of real hardware.
+    """
+
+    def __init__(self, baudrate=connection.LED_BAUDRATE, throttle=False, link=None):
+        self.baudrate = baudrate
+        self.throttle = throttle
+        self.decoder = VirtualBusDecoder(baudrate)
+        self.master_fd, self.slave_fd = pty.openpty()
+        # Keep the slave open so reads don't fail while no client is connected
+        tty.setraw(self.slave_fd)
+        self.device = os.ttyname(self.slave_fd)
+        self.link = link
+        if link:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.device, link)
+
+    def close(self):
+        if self.link and os.path.islink(self.link):
+            os.remove(self.link)
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def run(self, duration=None, report_interval=1.0):
+        start_time = time.monotonic()
+        prev_report_time = start_time
+        prev_frames = collections.Counter()
+        prev_bytes = 0
+        # Time at which the bytes received so far would have left the wire
+        wire_time = start_time
+        while duration is None or time.monotonic() - start_time < duration:
+            readable, _, _ = select.select([self.master_fd], [], [], 0.1)
+            if readable:
+                data = os.read(self.master_fd, 4096)
+                self.decoder.feed(data, time.monotonic())
+                if self.throttle:
+                    # Only accept bytes as fast as the configured baudrate allows
+                    # (10 bits per byte with start and stop bits)
+                    wire_time = max(wire_time, time.monotonic()) + len(data) * 10 / self.baudrate
+                    time.sleep(max(0, wire_time - time.monotonic()))
+
+            now = time.monotonic()
+            if now - prev_report_time >= report_interval:
+                self.report(now - prev_report_time, prev_frames, prev_bytes)
+                prev_frames = self.decoder.frames_received.copy()
+                prev_bytes = self.decoder.bytes_received
+                prev_report_time = now
+
+    def report(self, time_delta, prev_frames, prev_bytes):
+        decoder = self.decoder
+        byte_rate = (decoder.bytes_received - prev_bytes) / time_delta
+        print('%.0f bytes/s, link utilisation %.0f%% at %d baud, CRC failures: %d, noise bytes: %d, '
+              'multi-segment messages: %d, RLE messages: %d, palette messages: %d, latches: %d, '
+              'messages and latches missed while showing LEDs: %d, %d' % (
+                  byte_rate, 100 * byte_rate * 10 / self.baudrate, self.baudrate,
+                  sum(decoder.crc_failures.values()), decoder.noise_bytes, decoder.multi_msgs,
+                  decoder.rle_msgs, decoder.palette_msgs, decoder.latch_msgs,
+                  sum(decoder.missed_msgs.values()), sum(decoder.missed_latches.values())))
+        for uid in sorted(decoder.frames_received):
+            fps = (decoder.frames_received[uid] - prev_frames[uid]) / time_delta
+            print('  UID %3d: %6.1f fps, %d frames, %d CRC failures, %d missed latches' % (
+                uid, fps, decoder.frames_received[uid], decoder.crc_failures[uid],
+                decoder.missed_latches[uid]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Virtual LED bus that decodes the ATtiny serial protocol on a pseudo-terminal")
+    parser.add_argument("--link", help="Create a symlink to the pseudo-terminal at this path")
+    parser.add_argument("--baudrate", type=int, default=connection.LED_BAUDRATE,
+                        help="The baudrate of the emulated bus")
+    parser.add_argument("--throttle", action='store_true',
+                        help="Only accept data as fast as the baudrate allows")
+    parser.add_argument("--duration", type=float, help="Stop after this many seconds")
+    args = parser.parse_args()
+
+    bus = VirtualBus(baudrate=args.baudrate, throttle=args.throttle, link=args.link)
+    print('Virtual LED bus listening on %s' % (args.link or bus.device))
+    try:
+        bus.run(duration=args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bus.close()
+
+
+if __name__ == '__main__':
+    main()
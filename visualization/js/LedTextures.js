@@ -0,0 +1,164 @@
+import * as THREE from 'three';
+import * as BufferGeometryUtils from './BufferGeometryUtils.js';
+
+// Texture formats of the messages of TextureWebSocketsServer in controller/core/websockets.py
+const FORMAT_RGB565 = 2;
+const FORMAT_DELTA = 3;
+const KEYFRAME = 0;
+const HEADER_SIZE = 8;
+
+// Same layout as TextureLayout in controller/core/websockets.py, used until the controller
+// sends its layout.
+function defaultTextureLayout(numLeds) {
+    let side = 128;
+    while (side * side < numLeds && side < 2048) {
+        side *= 2;
+    }
+    return {
+        num_leds: numLeds,
+        texture_width: side,
+        texture_height: side,
+        num_textures: Math.max(1, Math.ceil(numLeds / (side * side))),
+    };
+}
+
+// Textures with the colors of all LEDs. They are allocated once for a texture layout and
+// every message from the controller updates them in place.
+class LedTextures {
+
+    constructor(layout) {
+        this.layout = layout;
+        this.pixelsPerTexture = layout.texture_width * layout.texture_height;
+        // One buffer backs all textures, so LEDs are decoded without looking up their texture
+        this.data = new Uint8Array(4 * this.pixelsPerTexture * layout.num_textures);
+        for (let i = 3; i < this.data.length; i += 4) {
+            this.data[i] = 255;
+        }
+        this.textures = [];
+        for (let t = 0; t < layout.num_textures; t++) {
+            const size = 4 * this.pixelsPerTexture;
+            const texture = new THREE.DataTexture(
+                this.data.subarray(t * size, (t + 1) * size), layout.texture_width, layout.texture_height);
+            texture.needsUpdate = true;
+            this.textures.push(texture);
+        }
+        // RGB colors of the last delta keyframe and the LEDs that the shown delta frame changed
+        this.keyframe = new Uint8Array(3 * layout.num_leds);
+        this.keyframeId = -1;
+        this.deltaIndices = null;
+    }
+
+    hasLayout(layout) {
+        return ['num_leds', 'texture_width', 'texture_height', 'num_textures'].every(
+            key => this.layout[key] == layout[key]);
+    }
+
+    // One mesh per texture with a cube for every LED of the LED config
+    createMeshes(ledConfigData, cubeWidth) {
+        const baseGeometry = new THREE.BoxGeometry(cubeWidth, cubeWidth, cubeWidth);
+        const cubes = this.textures.map(() => []);
+        var index = 0;
+        for (var segment of ledConfigData.led_segments) {
+            for (var led_positions of segment.led_positions) {
+                if (index >= this.layout.num_leds) {
+                    break;
+                }
+                var geometry = baseGeometry.clone();
+                geometry.applyMatrix4(new THREE.Matrix4().makeTranslation(led_positions[0], led_positions[1], led_positions[2]));
+                // Colors are in order of the LED config, row by row on the textures
+                const pixel = index % this.pixelsPerTexture;
+                const u = (pixel % this.layout.texture_width + 0.5) / this.layout.texture_width;
+                const v = (Math.floor(pixel / this.layout.texture_width) + 0.5) / this.layout.texture_height;
+                var uvAttribute = geometry.attributes.uv;
+                for (var i = 0; i < uvAttribute.count; i++) {
+                    uvAttribute.setXY(i, u, v);
+                }
+                cubes[Math.floor(index / this.pixelsPerTexture)].push(geometry);
+                index = index + 1;
+            }
+        }
+        const meshes = [];
+        for (let t = 0; t < this.textures.length; t++) {
+            if (!cubes[t].length) {
+                continue;
+            }
+            // Merge all geometries into one buffer for fast rendering.
+            const mergedGeometry = BufferGeometryUtils.mergeBufferGeometries(cubes[t], false);
+            meshes.push(new THREE.Mesh(mergedGeometry, new THREE.MeshBasicMaterial({ map: this.textures[t] })));
+        }
+        return meshes;
+    }
+
+    // Decodes a message from the controller into the textures.
+    // Returns whether the textures changed.
+    decode(buffer) {
+        const data = this.data;
+        if (buffer.byteLength == data.length) {
+            // Full RGBA textures
+            data.set(new Uint8Array(buffer));
+            this.deltaIndices = null;
+            return this.update();
+        }
+        const header = new DataView(buffer, 0, HEADER_SIZE);
+        const formatId = header.getUint8(0);
+        const isKeyframe = header.getUint8(1) == KEYFRAME;
+        const id = header.getUint16(2, true);
+        const count = Math.min(header.getUint32(4, true), this.layout.num_leds);
+        if (formatId == FORMAT_RGB565) {
+            const words = new Uint16Array(buffer, HEADER_SIZE, count);
+            for (let i = 0; i < count; i++) {
+                const r = (words[i] >> 11) & 0x1f, g = (words[i] >> 5) & 0x3f, b = words[i] & 0x1f;
+                data[i * 4] = (r << 3) | (r >> 2);
+                data[i * 4 + 1] = (g << 2) | (g >> 4);
+                data[i * 4 + 2] = (b << 3) | (b >> 2);
+            }
+            this.deltaIndices = null;
+        } else if (isKeyframe) {
+            // RGB888, also used for delta keyframes
+            const colors = new Uint8Array(buffer, HEADER_SIZE, 3 * count);
+            for (let i = 0; i < count; i++) {
+                data[i * 4] = colors[i * 3];
+                data[i * 4 + 1] = colors[i * 3 + 1];
+                data[i * 4 + 2] = colors[i * 3 + 2];
+            }
+            if (formatId == FORMAT_DELTA) {
+                this.keyframe.set(colors);
+                this.keyframeId = id;
+            }
+            this.deltaIndices = null;
+        } else {
+            // Changed LEDs since the keyframe
+            if (id != this.keyframeId) {
+                return false;
+            }
+            const keyframe = this.keyframe;
+            if (this.deltaIndices) {
+                for (const i of this.deltaIndices) {
+                    data[i * 4] = keyframe[i * 3];
+                    data[i * 4 + 1] = keyframe[i * 3 + 1];
+                    data[i * 4 + 2] = keyframe[i * 3 + 2];
+                }
+            }
+            const indices = this.layout.num_leds <= 65536 ?
+                new Uint16Array(buffer, HEADER_SIZE, count) : new Uint32Array(buffer, HEADER_SIZE, count);
+            const colors = new Uint8Array(buffer, HEADER_SIZE + indices.byteLength, 3 * count);
+            for (let j = 0; j < count; j++) {
+                const i = indices[j];
+                data[i * 4] = colors[j * 3];
+                data[i * 4 + 1] = colors[j * 3 + 1];
+                data[i * 4 + 2] = colors[j * 3 + 2];
+            }
+            this.deltaIndices = indices;
+        }
+        return this.update();
+    }
+
+    update() {
+        for (const texture of this.textures) {
+            texture.needsUpdate = true;
+        }
+        return true;
+    }
+}
+
+export { LedTextures, defaultTextureLayout };